@@ -0,0 +1,112 @@
+import sys, argparse
+sys.path.append('bot')
+import asyncio
+import json
+import time
+
+import openai
+from aiohttp import web
+
+import openai_utils
+import chat_client
+import http_client
+import key_pool
+
+# compares the openai client with the native SSE client against a local server
+
+parser = argparse.ArgumentParser(prog='chat streaming benchmark')
+parser.add_argument('-n', '--requests', type=int, default=50)
+parser.add_argument('-c', '--chunks', type=int, default=500)
+parser.add_argument('--port', type=int, default=8765)
+args = parser.parse_args()
+
+MODEL = openai_utils.MODEL_GPT_35_TURBO
+PROMPT = [{"role": "user", "content": "hello"}]
+
+def sse_chunk(content=None, finish_reason=None):
+    delta = {"content": content} if content is not None else {}
+    event = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": MODEL,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return "data: {}\n\n".format(json.dumps(event)).encode()
+
+async def completions(request):
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await response.write(sse_chunk(""))
+    for i in range(args.chunks):
+        await response.write(sse_chunk(f" token{i}"))
+    await response.write(sse_chunk(finish_reason="stop"))
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+async def run_openai(api_base):
+    r = await openai.ChatCompletion.acreate(
+        model=MODEL,
+        messages=PROMPT,
+        stream=True,
+        api_key="bench",
+        api_base=api_base,
+    )
+    first_chunk_time = None
+    async for buffer in r:
+        content_delta, finish_reason = openai_utils.reply_content(buffer, MODEL, stream=True)
+        if first_chunk_time is None:
+            first_chunk_time = time.monotonic()
+    return first_chunk_time
+
+async def run_native(credential):
+    first_chunk_time = None
+    async for content_delta, finish_reason in chat_client.stream_chat(PROMPT, MODEL, credential=credential):
+        if first_chunk_time is None:
+            first_chunk_time = time.monotonic()
+    return first_chunk_time
+
+async def measure(name, func):
+    first_chunk_latencies = []
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    for _ in range(args.requests):
+        start_time = time.monotonic()
+        first_chunk_time = await func()
+        first_chunk_latencies.append(first_chunk_time - start_time)
+    cpu_time = time.process_time() - cpu_start
+    wall_time = time.monotonic() - wall_start
+    num_chunks = args.requests * (args.chunks + 2)
+    first_chunk_latencies.sort()
+    print("{:<8} first chunk p50={:.2f}ms p95={:.2f}ms, cpu per chunk={:.2f}us, total wall={:.2f}s".format(
+        name,
+        first_chunk_latencies[len(first_chunk_latencies) // 2] * 1000,
+        first_chunk_latencies[int(len(first_chunk_latencies) * 0.95)] * 1000,
+        cpu_time / num_chunks * 1000000,
+        wall_time,
+    ))
+
+async def main():
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+
+    api_base = f"http://127.0.0.1:{args.port}/v1"
+    credential = key_pool.Credential("open_ai", "bench", api_base=api_base)
+    print(f"{args.requests} requests of {args.chunks} chunks")
+    try:
+        # warm up
+        await run_openai(api_base)
+        await run_native(credential)
+
+        await measure("openai", lambda: run_openai(api_base))
+        await measure("native", lambda: run_native(credential))
+    finally:
+        await http_client.close()
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(main())
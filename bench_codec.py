@@ -0,0 +1,62 @@
+import sys, argparse
+sys.path.append('bot')
+import glob
+import time
+
+import bson
+
+import codec
+
+# compares the decode cost of compressed chat documents with the transfer time saved by their smaller size
+
+parser = argparse.ArgumentParser(prog='storage codec benchmark')
+parser.add_argument('corpus', nargs='*', default=['README.md', 'locales/*/LC_MESSAGES/*.po'], help='text files, e.g. saved articles or transcripts')
+parser.add_argument('-n', '--repeat', type=int, default=200)
+parser.add_argument('--bandwidth', type=float, default=100, help='MB/s between MongoDB and the bot')
+args = parser.parse_args()
+
+def load_corpus():
+    texts = []
+    for pattern in args.corpus:
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            with open(path, encoding="utf-8", errors="replace") as f:
+                texts.append(f.read())
+    return texts
+
+def chat_document(text, encode):
+    # a link summary turn, the user message holds the whole content
+    message = {"user": text, "bot": text[:2000], "num_context_tokens": 0, "num_completion_tokens": 0}
+    return bson.encode({"_id": 0, "messages": [codec.encode_message(message) if encode else message]})
+
+def measure(data, decode):
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+        doc = bson.decode(data)
+        if decode:
+            codec.decode_messages(doc["messages"])
+    return (time.perf_counter() - start_time) / args.repeat
+
+def main():
+    texts = load_corpus()
+    if not texts:
+        print("empty corpus")
+        return
+    print("codec: {}, {} documents".format("zstd" if codec.zstandard is not None else "zlib", len(texts)))
+    total_raw = total_encoded = 0
+    total_raw_time = total_encoded_time = 0
+    for text in texts:
+        raw = chat_document(text, False)
+        encoded = chat_document(text, True)
+        total_raw += len(raw)
+        total_encoded += len(encoded)
+        total_raw_time += measure(raw, False)
+        total_encoded_time += measure(encoded, True)
+
+    saved_io_time = (total_raw - total_encoded) / (args.bandwidth * 1024 * 1024)
+    extra_decode_time = total_encoded_time - total_raw_time
+    print("size:   {:,} -> {:,} bytes ({:.1f}% saved)".format(total_raw, total_encoded, 100 * (1 - total_encoded / total_raw)))
+    print("decode: {:.3f}ms -> {:.3f}ms".format(total_raw_time * 1000, total_encoded_time * 1000))
+    print("transfer saved at {:.0f}MB/s: {:.3f}ms, extra decode: {:.3f}ms, net {:.3f}ms".format(args.bandwidth, saved_io_time * 1000, extra_decode_time * 1000, (saved_io_time - extra_decode_time) * 1000))
+
+if __name__ == "__main__":
+    main()
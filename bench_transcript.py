@@ -0,0 +1,61 @@
+import sys, os, argparse
+sys.path.append('bot')
+import glob
+import json
+import time
+
+import openai_utils
+import transcript
+
+# compares the prompt tokens of the transcript JSON with the compact line format over saved transcripts
+
+parser = argparse.ArgumentParser(prog='transcript encoding benchmark')
+parser.add_argument('corpus', help='directory of transcripts saved as JSON lists of {"text", "start", "duration"}')
+parser.add_argument('--save', nargs='*', default=[], help='YouTube video ids to download into the corpus first')
+parser.add_argument('--max-tokens', type=int, default=None)
+args = parser.parse_args()
+
+MODEL = openai_utils.MODEL_GPT_35_TURBO
+
+def save_transcripts(video_ids):
+    from youtube_transcript_api import YouTubeTranscriptApi
+    os.makedirs(args.corpus, exist_ok=True)
+    for video_id in video_ids:
+        transcript_list = YouTubeTranscriptApi.list_transcripts(video_id)
+        entries = transcript.select_transcript(transcript_list, []).fetch()
+        with open(os.path.join(args.corpus, f"{video_id}.json"), "w") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        print(f"saved {video_id}, {len(entries)} entries")
+
+def json_format(entries):
+    # the previous encoding
+    entries = [{k: v for k, v in entry.items() if k != "duration"} for entry in entries]
+    return json.dumps(entries, indent=4)
+
+def main():
+    save_transcripts(args.save)
+    paths = sorted(glob.glob(os.path.join(args.corpus, "*.json")))
+    if not paths:
+        print(f"no transcripts in {args.corpus}")
+        return
+
+    total_json_tokens = 0
+    total_compact_tokens = 0
+    total_time = 0
+    print("{:<24} {:>10} {:>10} {:>8}".format("transcript", "json", "compact", "saved"))
+    for path in paths:
+        with open(path) as f:
+            entries = json.load(f)
+        json_tokens = openai_utils.num_tokens_from_string(json_format(entries), MODEL)
+        start_time = time.monotonic()
+        compact = transcript.format_transcript(entries, MODEL, args.max_tokens or sys.maxsize)
+        total_time += time.monotonic() - start_time
+        compact_tokens = openai_utils.num_tokens_from_string(compact, MODEL)
+        total_json_tokens += json_tokens
+        total_compact_tokens += compact_tokens
+        print("{:<24} {:>10} {:>10} {:>7.1f}%".format(os.path.basename(path)[:24], json_tokens, compact_tokens, 100 * (1 - compact_tokens / json_tokens)))
+    print("{:<24} {:>10} {:>10} {:>7.1f}%".format("total", total_json_tokens, total_compact_tokens, 100 * (1 - total_compact_tokens / total_json_tokens)))
+    print("formatting took {:.1f}ms per transcript".format(total_time / len(paths) * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import sys, os, argparse
+sys.path.append('bot')
+import io
+import glob
+import time
+import asyncio
+
+from pydub import AudioSegment
+
+import audio_utils
+import openai_utils
+
+# compares the voice upload before and after skipping the WAV conversion, over saved voice messages
+
+parser = argparse.ArgumentParser(prog='voice upload benchmark')
+parser.add_argument('corpus', nargs='+', help='voice messages as downloaded from Telegram, e.g. *.ogg, the extension is the format')
+parser.add_argument('--transcribe', action='store_true', help='also time the Whisper requests, uses the configured OpenAI key')
+args = parser.parse_args()
+
+def convert_to_wav(data, format):
+    # what the bot did before, decode with pydub and upload as WAV
+    wav = io.BytesIO()
+    AudioSegment.from_file(io.BytesIO(data), format).export(wav, format="wav")
+    return audio_utils.AudioBuffer("voice.wav", wav.getvalue())
+
+async def measure(data, format, prepare):
+    start_time = time.perf_counter()
+    upload = await prepare(data, format)
+    prepare_time = time.perf_counter() - start_time
+    with upload:
+        size = upload.size()
+        transcribe_time = 0
+        if args.transcribe:
+            start_time = time.perf_counter()
+            await openai_utils.audio_transcribe(upload)
+            transcribe_time = time.perf_counter() - start_time
+    return size, prepare_time, transcribe_time
+
+async def prepare_before(data, format):
+    return convert_to_wav(data, format)
+
+async def prepare_after(data, format):
+    upload, method = await audio_utils.prepare_for_whisper(audio_utils.AudioBuffer(f"voice.{format}", data), format)
+    return upload
+
+async def main():
+    paths = sorted(p for pattern in args.corpus for p in glob.glob(pattern))
+    if not paths:
+        print("empty corpus")
+        return
+    totals = {"before": [0, 0, 0], "after": [0, 0, 0]}
+    for path in paths:
+        format = os.path.splitext(path)[1][1:]
+        with open(path, "rb") as f:
+            data = f.read()
+        for name, prepare in [("before", prepare_before), ("after", prepare_after)]:
+            result = await measure(data, format, prepare)
+            totals[name] = [total + value for total, value in zip(totals[name], result)]
+            print("{} {}: {:,} bytes, prepared in {:.3f}s, transcribed in {:.2f}s".format(path, name, *result))
+
+    before, after = totals["before"], totals["after"]
+    print("{} messages".format(len(paths)))
+    print("upload:     {:,} -> {:,} bytes ({:.1f}x smaller)".format(before[0], after[0], before[0] / max(after[0], 1)))
+    print("prepare:    {:.3f}s -> {:.3f}s".format(before[1], after[1]))
+    if args.transcribe:
+        print("transcribe: {:.2f}s -> {:.2f}s".format(before[2], after[2]))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+import json
+import time
+import hashlib
+import collections
+from datetime import datetime, timedelta
+
+import config
+import metrics
+import singleflight
+from database import Database
+
+# answers of history-free chat modes only depend on (chat mode, model, message)
+
+class LRUCache:
+    """In-process cache with TTL and LRU eviction."""
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expire_at, value = item
+        if time.monotonic() > expire_at:
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: int = None):
+        self.items[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key):
+        item = self.items.pop(key, None)
+        return item[1] if item is not None else None
+
+_memory = LRUCache(config.ANSWER_CACHE_SIZE, config.ANSWER_CACHE_TTL)
+# completions being generated, concurrent identical prompts wait for the same answer
+_flights = singleflight.SingleFlight("completion")
+
+def normalize_message(message: str):
+    return " ".join(message.split())
+
+def is_cacheable(chat_mode: dict):
+    return config.ANSWER_CACHE_ENABLED and "disable_history" in chat_mode
+
+def cache_key(chat_mode_id: str, system_prompt: str, model: str, message: str):
+    data = json.dumps([chat_mode_id, system_prompt, model, normalize_message(message)], ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def _report(hit: bool):
+    metrics.inc("answer_cache.hits" if hit else "answer_cache.misses")
+    metrics.inc("answer_cache.lookups")
+    metrics.set_gauge("answer_cache.hit_ratio", round(metrics.ratio("answer_cache.hits", "answer_cache.lookups"), 4))
+
+def get(db: Database, key: str):
+    """Returns the cached (answer, num_completion_tokens) or None."""
+    value = _memory.get(key)
+    if value is None:
+        doc = db.get_cached_answer(key)
+        if doc is not None:
+            value = (doc["answer"], doc["num_completion_tokens"])
+            remaining = (doc["expire_at"] - datetime.now()).total_seconds()
+            if remaining > 0:
+                _memory.set(key, value, ttl=remaining)
+    _report(value is not None)
+    return value
+
+def store(db: Database, key: str, answer: str, num_completion_tokens: int):
+    _memory.set(key, (answer, num_completion_tokens))
+    db.set_cached_answer(key, answer, num_completion_tokens, datetime.now() + timedelta(seconds=config.ANSWER_CACHE_TTL))
+
+async def wait_inflight(key: str):
+    """Waits for the answer being generated for the key, returns (answer, num_completion_tokens) or None."""
+    return await _flights.wait(key)
+
+def begin_flight(key: str):
+    """Marks the key as being generated, returns False if another chat is already generating it."""
+    if key in _flights:
+        return False
+    _flights.begin(key)
+    return True
+
+def end_flight(key: str, value=None):
+    """Hands the (answer, num_completion_tokens) to the waiters, None lets them generate their own."""
+    _flights.end(key, value)
+
+def billing_cost(num_prompt_tokens: int, num_completion_tokens: int, prompt_cost_factor: float, completion_cost_factor: float):
+    """Cost of an answer served from the cache, based on ANSWER_CACHE_BILLING."""
+    policy = config.ANSWER_CACHE_BILLING
+    if policy == "free":
+        return 0
+    if policy == "completion":
+        return int(num_completion_tokens * completion_cost_factor)
+    return int(num_prompt_tokens * prompt_cost_factor + num_completion_tokens * completion_cost_factor)
@@ -1,11 +1,12 @@
 import os
 import time
 import json
-import aiohttp
 import hashlib
 import hmac
 
 import config
+import http_client
+import deadline
 
 def hash_query(params):
     data_check_arr = []
@@ -33,14 +34,16 @@ async def api_request(endpoint, method='GET', params = None, data = None):
     hash = hash_query(params)
     params['hash'] = hash
     
-    async with aiohttp.ClientSession() as session:
-        async with session.request(method, url, params=params, json=data) as response:
-            if response.status == 200:
-                response_data = await response.json()
-                return response_data
-            else:
-                # handle error response
-                return None
+    return await deadline.run("api", _request(method, url, params, data))
+
+async def _request(method, url, params, data):
+    async with http_client.get().request(method, url, params=params, json=data) as response:
+        if response.status == 200:
+            response_data = await response.json()
+            return response_data
+        else:
+            # handle error response
+            return None
 
 
 async def create_order(user_id, payment_method, price, token_amount):
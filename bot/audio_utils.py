@@ -0,0 +1,100 @@
+import io
+import asyncio
+import tempfile
+
+import config
+import metrics
+
+# audio is processed in memory and piped through ffmpeg, buffers only spill to disk above AUDIO_SPOOL_MAX_BYTES,
+# MP4 family inputs are the exception, ffmpeg reads them from a temporary file
+
+# formats accepted by the Whisper API, recognized by the file extension
+WHISPER_FORMATS = set(["flac", "m4a", "mp3", "mp4", "mpeg", "mpga", "oga", "ogg", "wav", "webm"])
+
+class FFmpegError(Exception):
+    pass
+
+class AudioBuffer(tempfile.SpooledTemporaryFile):
+    """In-memory file with a name, the upload APIs take the format from it."""
+
+    def __init__(self, name: str, data: bytes = None):
+        super().__init__(max_size=config.AUDIO_SPOOL_MAX_BYTES)
+        self._name = name
+        if data is not None:
+            self.write(data)
+            self.seek(0)
+
+    @property
+    def name(self):
+        return self._name
+
+    def size(self):
+        position = self.tell()
+        self.seek(0, io.SEEK_END)
+        size = self.tell()
+        self.seek(position)
+        return size
+
+async def ffmpeg(*args, input: bytes = None):
+    """Runs ffmpeg with `pipe:0` and `pipe:1` for the input and output, returns the output."""
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-loglevel", "error", *args,
+        stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await process.communicate(input)
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    if process.returncode != 0:
+        raise FFmpegError(stderr.decode(errors="replace").strip())
+    return stdout
+
+def is_iso_media(data: bytes):
+    """MP4, M4A, MOV and 3GP files start with an ftyp box."""
+    return data[4:8] == b"ftyp"
+
+async def _convert(data: bytes, *args):
+    """Runs ffmpeg on the audio with the output args, the output goes to `pipe:1`."""
+    if is_iso_media(data):
+        # the moov atom is often at the end, ffmpeg can't seek back to it in a pipe
+        with tempfile.NamedTemporaryFile() as source:
+            source.write(data)
+            source.flush()
+            return await ffmpeg("-i", source.name, *args)
+    return await ffmpeg("-i", "pipe:0", *args, input=data)
+
+async def prepare_for_whisper(audio: AudioBuffer, format: str):
+    """Returns the buffer to upload and how it was made: "as_is", "remux" or "encode"."""
+    if format in WHISPER_FORMATS:
+        # e.g. Telegram voice notes are Opus in OGG
+        audio.seek(0)
+        return audio, "as_is"
+    audio.seek(0)
+    data = audio.read()
+    try:
+        # copy the audio stream into a WebM container without decoding it
+        remuxed = await _convert(data, "-vn", "-c:a", "copy", "-f", "webm", "pipe:1")
+        return AudioBuffer("voice.webm", remuxed), "remux"
+    except FFmpegError as e:
+        print(f"failed to remux {format}: {e}")
+    # the codec doesn't fit in WebM, encode a small mono MP3, Whisper resamples to 16kHz anyway
+    encoded = await _convert(data, "-vn", "-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-b:a", "32k", "-f", "mp3", "pipe:1")
+    return AudioBuffer("voice.mp3", encoded), "encode"
+
+async def wav_to_opus(wav: bytes):
+    """Encodes to OGG/Opus, Telegram only shows the waveform of voice messages in Opus."""
+    return await ffmpeg("-f", "wav", "-i", "pipe:0", "-c:a", "libopus", "-f", "ogg", "pipe:1", input=wav)
+
+def report_upload(method: str, num_bytes: int, latency: float):
+    # sizes are counters, the latency windows would print them as seconds
+    metrics.inc("voice.uploads")
+    metrics.inc(f"voice.uploads.{method}")
+    metrics.inc("voice.upload_bytes", num_bytes)
+    metrics.inc(f"voice.upload_bytes.{method}", num_bytes)
+    metrics.set_gauge(f"voice.upload_bytes_avg.{method}", round(metrics.ratio(f"voice.upload_bytes.{method}", f"voice.uploads.{method}")))
+    metrics.observe("voice.transcription", latency)
+    metrics.observe(f"voice.transcription.{method}", latency)
+    print(f"voice {method}: {num_bytes} bytes, transcribed in {latency:.2f}s")
@@ -1,10 +1,12 @@
 import os
+import io
 import logging
 import traceback
 import html
 import json
 import re
-import math
+import time
+import asyncio
 from datetime import datetime
 
 import telegram
@@ -21,10 +23,7 @@ from telegram.ext import (
 )
 from telegram.constants import ParseMode, ChatAction
 
-from pydub import AudioSegment
 
-from youtube_transcript_api import YouTubeTranscriptApi, _errors
-import trafilatura
 
 import config
 import database
@@ -37,6 +36,23 @@ import ui
 import helper
 import i18n
 import bugreport
+import metrics
+import generations
+import outbound
+import markdown_renderer
+import answer_cache
+import singleflight
+import http_client
+import deadline
+import compaction
+import retrieval
+import summarizer
+import transcript
+import web_fetch
+import url_cache
+import youtube
+import audio_utils
+from dispatcher import serialized
 
 # setup
 db = database.Database()
@@ -52,6 +68,7 @@ def get_commands(lang=i18n.DEFAULT_LOCALE):
         BotCommand("dictionary", _("switch to Dictionary mode")),
         BotCommand("image", _("generate images")),
         BotCommand("reset", _("start a new conversation")),
+        BotCommand("stop", _("stop generating the answer")),
         BotCommand("balance", _("check balance")),
         BotCommand("settings", _("settings")),
         # BotCommand("earn", _("earn rewards by referral")),
@@ -89,7 +106,8 @@ async def register_user_if_not_exists(update: Update, context: CallbackContext,
 
 async def reply_or_edit_text(update: Update, text: str, parse_mode: ParseMode = ParseMode.HTML, reply_markup = None, disable_web_page_preview = None):
     if update.message:
-        await update.message.reply_text(
+        await outbound.reply_text(
+            update.message,
             text,
             parse_mode=parse_mode,
             reply_markup=reply_markup,
@@ -97,7 +115,8 @@ async def reply_or_edit_text(update: Update, text: str, parse_mode: ParseMode =
         )
     elif update.callback_query:
         query = update.callback_query
-        await query.edit_message_text(
+        await outbound.edit_message_text(
+            query,
             text,
             parse_mode=parse_mode,
             reply_markup=reply_markup,
@@ -134,7 +153,8 @@ async def start_handle(update: Update, context: CallbackContext):
         reply_markup = InlineKeyboardMarkup([
             [InlineKeyboardButton("👛 " + _("Check balance"), callback_data="balance")]
         ])
-        await update.message.reply_text(
+        await outbound.reply_text(
+            update.message,
             _("✅ {:,} free tokens have been credited").format(config.FREE_QUOTA), 
             parse_mode=ParseMode.HTML,
             reply_markup=reply_markup,
@@ -151,7 +171,7 @@ async def retry_handle(update: Update, context: CallbackContext):
 
     messages = db.get_chat_messages(chat_id)
     if not messages or len(messages) == 0:
-        await update.message.reply_text(_("😅 No conversation history to retry"))
+        await outbound.reply_text(update.message, _("😅 No conversation history to retry"))
         return
 
     last_dialog_message = messages.pop()
@@ -175,12 +195,16 @@ def strip_command(message):
         return m[2].strip()
     return None
 
+def is_bare_command(update: Update):
+    # commands without text switch chat modes or models
+    return update.message is not None and update.message.text is not None and not strip_command(update.message.text)
+
 async def send_error(update: Update, context: CallbackContext, message: str = None, placeholder = None):
     text = "⚠️ " + message
     if placeholder is None:
-        await update.effective_message.reply_text(text)
+        await outbound.reply_text(update.effective_message, text)
     else:
-        await placeholder.edit_text(text)
+        await outbound.edit_text(placeholder, text)
 
 async def send_openai_error(update: Update, context: CallbackContext, e: Exception, placeholder = None):
     user = await register_user_if_not_exists(update, context)
@@ -217,7 +241,7 @@ async def send_insufficient_tokens_warning(update: Update, user: User, message:
     text = "⚠️ " + _("Insufficient tokens.")
     if estimated_cost is not None:
         text += " " + _("Require {} tokens to process this message").format(i18n.currency(estimated_cost))
-    await update.effective_message.reply_text(text, reply_markup=reply_markup)
+    await outbound.reply_text(update.effective_message, text, reply_markup=reply_markup)
 
 async def check_balance(update: Update, estimated_cost: int, user: User):
     remaining_tokens = db.get_user_remaining_tokens(user.id)
@@ -247,7 +271,7 @@ async def common_command_handle(update: Update, context: CallbackContext):
         message = db.get_cached_message(cached_msg_id)
 
         if not message:
-            await update.effective_message.edit_text(update.effective_message.text, parse_mode=ParseMode.MARKDOWN, reply_markup=None)
+            await outbound.edit_text(update.effective_message, update.effective_message.text_html, parse_mode=ParseMode.HTML, reply_markup=None)
             return
     else:
         message = update.message.text
@@ -293,71 +317,47 @@ async def voice_message_handle(update: Update, context: CallbackContext):
         if not await check_balance(update, estimated_cost, user):
             return
         
-        placeholder = await update.effective_message.reply_text("🎙 " + _("Decoding voice message ..."))
+        placeholder = await outbound.reply_text(update.effective_message, "🎙 " + _("Decoding voice message ..."))
 
+        start_time = time.monotonic()
         file_id = voice.file_id
         type = voice.mime_type.split("/")[1]
         new_file = await context.bot.get_file(file_id)
-        src_filename = os.path.join(config.AUDIO_FILE_TMP_DIR, file_id)
-        filename = src_filename
-        await new_file.download_to_drive(src_filename)
-        if type not in ['m4a', 'mp3', 'webm', 'mp4', 'mpga', 'wav', 'mpeg']:
-            # convert to wav if source format is not supported by OpenAI
-            wav_filename = src_filename + ".wav"
-            seg = AudioSegment.from_file(src_filename, type)
-            seg.export(wav_filename, format='wav')
-            filename = wav_filename
-
-        file_size = os.path.getsize(filename)
-        print(f"size: {file_size}/{config.WHISPER_FILE_SIZE_LIMIT}")
-        if file_size < config.WHISPER_FILE_SIZE_LIMIT:
-            text = await openai_utils.audio_transcribe(filename)
-            if estimated_cost > 0:
-                print(f"voice used tokens: {estimated_cost}")
-                db.inc_user_used_tokens(user.id, estimated_cost)
-            await message_handle(update, context, text, placeholder=placeholder)
-        else:
-            await placeholder.edit_text("⚠️ " + _("Voice data size exceeds 20MB limit"))
-        # clean up
-        os.remove(filename)
-        if os.path.exists(src_filename):
-            os.remove(src_filename)
-        
+        # Whisper recognizes the format by the extension
+        with audio_utils.AudioBuffer(f"voice.{type}") as audio:
+            await new_file.download_to_memory(out=audio)
+            # Opus voice notes are sent as they are, other formats are remuxed or encoded compressed
+            upload, method = await audio_utils.prepare_for_whisper(audio, type)
+            with upload:
+                file_size = upload.size()
+                print(f"size: {file_size}/{config.WHISPER_FILE_SIZE_LIMIT}")
+                if file_size >= config.WHISPER_FILE_SIZE_LIMIT:
+                    await outbound.edit_text(placeholder, "⚠️ " + _("Voice data size exceeds 20MB limit"))
+                    return
+                text = await openai_utils.audio_transcribe(upload)
+        audio_utils.report_upload(method, file_size, time.monotonic() - start_time)
+        if estimated_cost > 0:
+            print(f"voice used tokens: {estimated_cost}")
+            db.inc_user_used_tokens(user.id, estimated_cost)
+        await message_handle(update, context, text, placeholder=placeholder)
+
     except Exception as e:
         await send_openai_error(update, context, e, placeholder=placeholder)
 
-def _build_youtube_prompt(url, _):
-    video_id = helper.parse_youtube_id(url)
-    print(f"parsing youtube {video_id} transcript ...")
-    try:
-        transcript_list = YouTubeTranscriptApi.list_transcripts(video_id)
-        for transcript in transcript_list:
-            # the Transcript object provides metadata properties
-            print(
-                transcript.video_id,
-                transcript.language,
-                transcript.language_code,
-                # whether it has been manually created or generated by YouTube
-                transcript.is_generated,
-                # whether this transcript can be translated or not
-                transcript.is_translatable,
-                # a list of languages the transcript can be translated to
-                # transcript.translation_languages,
-            )
+# concurrent requests of the same link share one fetch
+url_flights = singleflight.SingleFlight("url")
+youtube_flights = singleflight.SingleFlight("youtube")
 
-            transcript_json = transcript.fetch()
-            # strip redundant data to reduce prompt token usage
-            for line in transcript_json:
-                if "duration" in line:
-                    del line["duration"]
-            return json.dumps(transcript_json, indent=4)
-    except _errors.TranscriptsDisabled as e:
-        print("Youtube error: transcripts are disabled")
-    except Exception as e:
-        print(e)
-    return None
+async def fetch_web_content(url):
+    # the download is bounded by the fetch timeout in url_cache
+    return await url_flights.do(helper.normalize_url(url), url_cache.get_text, db, url)
+
+async def build_youtube_prompt(url, lang=None):
+    video_id = helper.parse_youtube_id(url)
+    languages = transcript.preferred_languages(lang)
+    return await deadline.run("youtube", youtube_flights.do((video_id, tuple(languages)), youtube.get_transcript, db, video_id, languages))
 
-async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True, chat_mode_id=None, placeholder: Message=None, cached_msg_id=None, upscale=False):
+async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True, chat_mode_id=None, placeholder: Message=None, cached_msg_id=None, upscale=False, answer_cache_key=None, cached_answer=None, history_message=None, reply_markup=None, precomputed_answer=None):
     user = await register_user_if_not_exists(update, context)
     chat_id = update.effective_chat.id
     
@@ -370,7 +370,6 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
 
     user_id = user.id
     chat = update.effective_chat
-    reply_markup = None
 
     voice_mode = db.get_chat_voice_mode(chat_id)
 
@@ -393,7 +392,7 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
             if not cached_message.startswith("/"):
                 cached_message = "/{} {}".format(chat_mode_id, cached_message)
             cached_msg_id = db.cache_chat_message(cached_message)
-        reply_markup = InlineKeyboardMarkup([
+        reply_markup = reply_markup or InlineKeyboardMarkup([
             [InlineKeyboardButton(_("Retry"), callback_data=f"retry|{cached_msg_id}")]
         ])
     elif use_new_dialog_timeout:
@@ -420,7 +419,7 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
     # telegram flood control limit is 20 messages per minute, we set 12 to leave some budget
     if rate_count >= rate_limit:
         if rate_count < rate_limit + 3:
-            await update.effective_message.reply_text(_("⚠️ This chat has exceeded the rate limit. Please wait for up to 60 seconds."), parse_mode=ParseMode.HTML)
+            await outbound.reply_text(update.effective_message, _("⚠️ This chat has exceeded the rate limit. Please wait for up to 60 seconds."), parse_mode=ParseMode.HTML)
         return
 
     db.set_user_attribute(user_id, "last_interaction", datetime.now())
@@ -437,7 +436,8 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
     model_id = db.get_current_model(chat_id)
     model = openai_utils.MODEL_GPT_4 if model_id == "gpt4" else openai_utils.MODEL_GPT_35_TURBO 
     # load chat history to context
-    messages = db.get_chat_messages(chat_id) if not disable_history else []
+    messages, summary = db.get_chat_messages_and_summary(chat_id) if not disable_history else ([], None)
+    messages = messages or []
 
     context_content = None
     if message is None:
@@ -445,7 +445,23 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         # load long text to the context if any
         context_content, context_src = db.get_chat_context(chat_id)
         if context_content is not None:
-            system_prompt = "You are an assistant to answer the questions about the content of {}.\n\ncontent:\n{}".format(context_src, context_content)
+            # only send the parts of long content relevant to the question and the previous one
+            query = " ".join([messages[-1]["user"], message]) if messages else message
+            context_summary, context_mode = db.get_chat_context_summary(chat_id)
+            if context_summary is not None and context_mode == "distilled" and config.CONTEXT_DISTILLATION:
+                # after the summary, the summary and a few excerpts are enough for most follow-ups
+                content = retrieval.select_context(context_content, query, openai_utils.MODEL_GPT_35_TURBO, min_tokens=config.CONTEXT_DISTILLED_BUDGET, budget=config.CONTEXT_DISTILLED_BUDGET)[0]
+                if any(m["bot"] == context_summary for m in messages):
+                    # the summary is still in the history, not sent twice
+                    system_prompt = "You are an assistant to answer the questions about the content of {}.\n\nexcerpts of the content relevant to the question:\n{}".format(context_src, content)
+                else:
+                    system_prompt = "You are an assistant to answer the questions about the content of {}.\n\nsummary of the content:\n{}\n\nexcerpts of the content relevant to the question:\n{}".format(context_src, context_summary, content)
+            else:
+                content, context_mode = retrieval.select_context(context_content, query, openai_utils.MODEL_GPT_35_TURBO)
+                if context_mode == "full":
+                    system_prompt = "You are an assistant to answer the questions about the content of {}.\n\ncontent:\n{}".format(context_src, content)
+                else:
+                    system_prompt = "You are an assistant to answer the questions about the content of {}.\n\nexcerpts of the content relevant to the question:\n{}".format(context_src, content)
             upscale = True
 
     message = message.strip()
@@ -454,65 +470,76 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
     if is_url:
         url = message
         if helper.is_youtube_url(url):
-            message = _build_youtube_prompt(url, _)
+            try:
+                message = await build_youtube_prompt(url, db.get_chat_lang(chat_id) or user.language_code)
+            except deadline.UpstreamTimeout:
+                message = None
             if message is None:
-                await update.effective_message.reply_text(_("⚠️ Transcripts for this video are not available, possibly due to access restrictions or transcript disablement."), parse_mode=ParseMode.HTML)
+                await outbound.reply_text(update.effective_message, _("⚠️ Transcripts for this video are not available, possibly due to access restrictions or transcript disablement."), parse_mode=ParseMode.HTML)
                 return
         else:
-            downloaded = trafilatura.fetch_url(url)
-            message = trafilatura.extract(downloaded, include_comments=False)
+            message = await fetch_web_content(url)
             if message is None:
-                await update.effective_message.reply_text(_("⚠️ Failed to fetch the website content, possibly due to access restrictions."), parse_mode=ParseMode.HTML)
+                await outbound.reply_text(update.effective_message, _("⚠️ Failed to fetch the website content, possibly due to access restrictions."), parse_mode=ParseMode.HTML)
                 return
-        upscale = True
+
+        # long content is fine, questions only send the relevant chunks and summaries are map-reduced
+        num_content_tokens = openai_utils.num_tokens_from_string(message, openai_utils.MODEL_GPT_35_TURBO)
+        if config.RETRIEVAL_ENABLED and num_content_tokens > config.RETRIEVAL_MIN_TOKENS:
+            num_content_tokens = config.RETRIEVAL_BUDGET
+        estimated_cost = int(num_content_tokens * chatgpt.cost_factors(model)[0])
+        if not await check_balance(update, estimated_cost, user):
+            return
+        db.set_chat_context(chat_id, message, url)
+        # index the content for the follow-up questions
+        retrieval.get_index(message, openai_utils.MODEL_GPT_35_TURBO)
+        text = _("Now you can ask me about the content in the link:")
+        text += "\n" + url
+        text += "\n\n"
+        text += ui.build_tips([
+            _("The cost of the next answers will be more than {} tokens").format(i18n.currency(estimated_cost)),
+            _("To reduce costs, you can use the /reset command to remove the data from the context"),
+        ], _, title=_("Notice"))
+        reply_markup = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(_("Summarize"), callback_data="summarize"),
+                InlineKeyboardButton(_("Cancel"), callback_data="reset"),
+            ]
+        ])
+        await outbound.reply_text(update.effective_message, text, reply_markup=reply_markup, disable_web_page_preview=True)
+        if config.SPECULATIVE_SUMMARY:
+            speculate_summary(chat_id, user_id, chat_mode_id, system_prompt, model, url, message, _)
+        return
 
     voice_placeholder = None    
     answer = None
     sent_answer = None
     num_completion_tokens = None
-    # handle long message that exceeds telegram's limit
-    n_message_chunks = 0
-    current_message_chunk_index = 0
-    n_sent_chunks = 0
     # handle too many tokens
     max_message_count = -1
 
-    if upscale:
-        model = chatgpt.resolve_model(model, openai_utils.num_tokens_from_string(system_prompt + " " + message, model))
+    remaining_tokens = db.get_user_remaining_tokens(user_id)
+    # route to a model of the chosen tier by the size of the new input, the history is trimmed rather than escalated
+    num_estimated_tokens = openai_utils.num_tokens_from_string(" ".join([system_prompt, summary or "", message]), model)
+    history_max_tokens = openai_utils.max_context_tokens(chatgpt.default_model(model))
+    model = chatgpt.resolve_model(model, num_estimated_tokens, chat_mode_id=chat_mode_id, remaining_tokens=remaining_tokens)
 
     prompt_cost_factor, completion_cost_factor = chatgpt.cost_factors(model)
-    remaining_tokens = db.get_user_remaining_tokens(user_id)
     max_affordable_tokens = int(remaining_tokens / prompt_cost_factor)
     # determine if enabling saving mode
     if remaining_tokens < 10000 or chat_mode_id not in config.DEFAULT_CHAT_MODES:
         # enable token saving mode for low balance users and external modes
         max_affordable_tokens = min(max_affordable_tokens, 2000)
 
-    prompt, num_prompt_tokens, n_first_dialog_messages_removed = chatgpt.build_prompt(system_prompt, messages, message, model, max_affordable_tokens)
-    if num_prompt_tokens > openai_utils.max_context_tokens(model):
-        await update.effective_message.reply_text(_("⚠️ Sorry, the message is too long for {}. Please reduce the length of the input data.").format(model))
+    # a long-context model only takes the long input, the history still fits the default model's window
+    prompt, num_prompt_tokens, n_first_dialog_messages_removed = chatgpt.build_prompt(system_prompt, messages, message, model, min(max_affordable_tokens, history_max_tokens), summary=summary)
+    if cached_answer is None and num_prompt_tokens > openai_utils.max_context_tokens(model):
+        await outbound.reply_text(update.effective_message, _("⚠️ Sorry, the message is too long for {}. Please reduce the length of the input data.").format(model))
         return
     estimated_cost = int(num_prompt_tokens * prompt_cost_factor)
     if not await check_balance(update, estimated_cost, user):
         return
     
-    if is_url:
-        db.set_chat_context(chat_id, message, url)
-        text = _("Now you can ask me about the content in the link:")
-        text += "\n" + url
-        text += "\n\n"
-        text += ui.build_tips([
-            _("The cost of the next answers will be more than {} tokens").format(i18n.currency(estimated_cost)),
-            _("To reduce costs, you can use the /reset command to remove the data from the context"),
-        ], _, title=_("Notice"))
-        reply_markup = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(_("Summarize"), callback_data="summarize"),
-                InlineKeyboardButton(_("Cancel"), callback_data="reset"),
-            ]
-        ])
-        await update.effective_message.reply_text(text, reply_markup=reply_markup, disable_web_page_preview=True)
-        return
     # send warning if some messages were removed from the context
     if n_first_dialog_messages_removed > 0:
         # if n_first_dialog_messages_removed == 1:
@@ -523,11 +550,38 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         print(f"removed {n_first_dialog_messages_removed} messages from context")
         max_message_count = len(messages) + 1 - n_first_dialog_messages_removed
 
-    try:
-        api_type = config.OPENAI_CHAT_API_TYPE
-        # if api_type != config.DEFAULT_OPENAI_API_TYPE and "api_type" in config.CHAT_MODES[chat_mode]:
-        #     api_type = config.CHAT_MODES[chat_mode]["api_type"]
-
+    api_type = config.OPENAI_CHAT_API_TYPE
+    # if api_type != config.DEFAULT_OPENAI_API_TYPE and "api_type" in config.CHAT_MODES[chat_mode]:
+    #     api_type = config.CHAT_MODES[chat_mode]["api_type"]
+
+    # answers of the chat modes without history are shared across chats
+    # retry always generates a new answer
+    lookup_cache = update.callback_query is None
+    prepaid = False
+    if precomputed_answer is not None:
+        # e.g. the summary generated in the background after ingesting the link
+        answer_text, num_answer_tokens, prepaid = precomputed_answer
+        cached_answer = (answer_text, num_answer_tokens)
+        lookup_cache = False
+    elif answer_cache_key is not None:
+        # given by the caller with the cached answer it looked up, e.g. summaries of the same content
+        lookup_cache = True
+    elif answer_cache.is_cacheable(chat_mode) and context_content is None:
+        answer_cache_key = answer_cache.cache_key(chat_mode_id, system_prompt, model, message)
+        if lookup_cache:
+            cached_answer = answer_cache.get(db, answer_cache_key)
+
+    # identical prompts generated at the same time share one completion
+    flight_key = answer_cache_key
+    if flight_key is None and upscale and not messages and context_content is None:
+        # long inputs like link summaries are often requested by many chats at once
+        flight_key = answer_cache.cache_key(chat_mode_id, system_prompt, model, message)
+    if flight_key is not None and cached_answer is None and lookup_cache:
+        cached_answer = await answer_cache.wait_inflight(flight_key)
+
+    if cached_answer is not None:
+        stream = chatgpt.replay_answer(*cached_answer)
+    else:
         stream = chatgpt.send_message(
             prompt,
             model=model,
@@ -535,97 +589,132 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
             stream=config.STREAM_ENABLED,
             api_type=api_type,
         )
+    cancelled = False
+    completed = False
 
-        prev_answer = ""
-        
-        if api_type == "azure":
-            stream_len = 150 if chat.type == Chat.PRIVATE else 200
-        else:
-            stream_len = 100 if chat.type == Chat.PRIVATE else 150
+    async def stream_answer():
+        nonlocal placeholder, answer, sent_answer, num_completion_tokens, cancelled, completed
+        # messages showing each chunk of the answer and their current texts
+        chunk_messages = []
+        chunk_texts = []
 
-        if placeholder is None:
-            placeholder = await update.effective_message.reply_text("...")
-        
-        async for buffer in stream:
-            finished, answer, num_completion_tokens = buffer
+        # renders the Markdown answer to Telegram HTML chunks split at block boundaries
+        renderer = markdown_renderer.Renderer()
 
-            if not finished and len(answer) - len(prev_answer) < stream_len:
-                # reduce edit message requests
-                continue
-            prev_answer = answer
+        async def edit_chunk(index, text, reply_markup, final):
+            try:
+                await outbound.edit_text(chunk_messages[index], text, parse_mode=ParseMode.HTML, reply_markup=reply_markup, final=final)
+            except telegram.error.BadRequest as e:
+                # should never happen, the rendered HTML is always valid
+                await outbound.edit_text(chunk_messages[index], html.unescape(re.sub(r"<[^>]+>", "", text)), parse_mode=None, reply_markup=reply_markup)
+                print("Telegram errors while editing text: {}".format(e))
+            chunk_texts[index] = text
 
-            if finished:
-                parse_mode = ParseMode.MARKDOWN
-                final_reply_markup = reply_markup
-            else:
-                parse_mode = None
-                final_reply_markup = None
-
-            # send warning if the anwser is too long (based on telegram's limit)
-            if len(answer) > config.MESSAGE_MAX_LENGTH:
-                parse_mode = None
-
-            # send answer chunks
-            n_message_chunks = math.ceil(len(answer) / config.MESSAGE_MAX_LENGTH)
-            for chuck_index in range(current_message_chunk_index, n_message_chunks):
-                start_index = chuck_index * config.MESSAGE_MAX_LENGTH
-                end_index = (chuck_index + 1) * config.MESSAGE_MAX_LENGTH
-                message_chunk = answer[start_index:end_index]
-                if not finished:
-                    message_chunk += " ..."
-                if current_message_chunk_index < n_message_chunks - 1 or placeholder is None:
-                    # send a new message chunk
-                    placeholder = await update.effective_message.reply_text(message_chunk, parse_mode=parse_mode, reply_markup=final_reply_markup)
-                elif placeholder is not None:
-                    # update last message chunk
-                    try:
-                        await placeholder.edit_text(message_chunk, parse_mode=parse_mode, reply_markup=final_reply_markup)
-                    except telegram.error.BadRequest as e:
-                        if str(e).startswith("Message is not modified"):
-                            continue
-                        # May encounter parsing errors, send plaintext instead
-                        await placeholder.edit_text(message_chunk, parse_mode=None, reply_markup=final_reply_markup)
-                        print("Telegram errors while editing text: {}".format(e))
-                sent_answer = answer[0:end_index]
-                current_message_chunk_index = chuck_index
-                n_sent_chunks = chuck_index + 1
-
-        # send warning if the anwser is too long (based on telegram's limit)
-        if len(answer) > config.MESSAGE_MAX_LENGTH:
-            await update.effective_message.reply_text(_("⚠️ The answer was too long, has been splitted into multiple unformatted messages"))
-    except telegram.error.BadRequest as e:
-        error_text = f"Errors from Telegram: {e}"
-        logger.error(error_text)    
-        if answer and n_sent_chunks < n_message_chunks:
-            # send remaining answer chunks
-            chunks = get_message_chunks(answer)
-            for i in range(current_message_chunk_index + 1, n_message_chunks):
-                chunk = chunks[i]
-                # answer may have invalid characters, so we send it without parse_mode
-                await update.effective_message.reply_text(chunk, reply_markup=final_reply_markup)
-            sent_answer = answer
-    except Exception as e:
-        await send_openai_error(update, context, e)
+        try:
+            if placeholder is None:
+                placeholder = await outbound.reply_text(update.effective_message, "...")
+            chunk_messages.append(placeholder)
+            chunk_texts.append(None)
+            
+            async for buffer in stream:
+                finished, answer, num_completion_tokens = buffer
+                final_reply_markup = reply_markup if finished else None
+
+                # send answer chunks, intermediate edits are coalesced and paced by the outbound scheduler
+                chunks = renderer.render(answer)
+                for index, message_chunk in enumerate(chunks):
+                    is_last_chunk = index == len(chunks) - 1
+                    if not finished and is_last_chunk:
+                        message_chunk += " ..."
+                    if not message_chunk.strip():
+                        message_chunk = "..."
+                    if index < len(chunk_texts) and chunk_texts[index] == message_chunk:
+                        continue
+                    chunk_reply_markup = final_reply_markup if is_last_chunk else None
+                    if index < len(chunk_messages):
+                        # earlier chunks won't change anymore
+                        await edit_chunk(index, message_chunk, chunk_reply_markup, final=finished or not is_last_chunk)
+                    else:
+                        # send a new message chunk
+                        chunk_messages.append(await outbound.reply_text(update.effective_message, message_chunk, parse_mode=ParseMode.HTML, reply_markup=chunk_reply_markup))
+                        chunk_texts.append(message_chunk)
+                sent_answer = answer
+            completed = True
+        except asyncio.CancelledError:
+            # stopped by /stop, /reset or switching chat modes
+            cancelled = True
+            # close the upstream stream in case it's waiting on telegram
+            await stream.aclose()
+            if answer and chunk_messages:
+                try:
+                    # drop the trailing " ..." of the last chunk
+                    chunks = renderer.render(answer)
+                    index = min(len(chunks), len(chunk_messages)) - 1
+                    await outbound.edit_text(chunk_messages[index], chunks[index], parse_mode=ParseMode.HTML)
+                except Exception as e:
+                    print(e)
+        except telegram.error.BadRequest as e:
+            error_text = f"Errors from Telegram: {e}"
+            logger.error(error_text)    
+        except Exception as e:
+            await send_openai_error(update, context, e)
+
+    leading_flight = flight_key is not None and cached_answer is None and answer_cache.begin_flight(flight_key)
+    generation_start_time = time.monotonic()
+    generation = asyncio.ensure_future(stream_answer())
+    generations.register(chat_id, generation)
+    try:
+        await generation
+    finally:
+        generations.unregister(chat_id, generation)
+        if leading_flight:
+            shared_answer = None
+            if completed and sent_answer is not None and num_completion_tokens is not None:
+                shared_answer = (sent_answer, num_completion_tokens)
+            answer_cache.end_flight(flight_key, shared_answer)
+
+    if context_content is not None and completed:
+        # compare questions answered from retrieved chunks against the full content
+        metrics.observe(f"context.answer.{context_mode}", time.monotonic() - generation_start_time)
+        metrics.inc(f"context.turns.{context_mode}")
+        metrics.inc(f"context.prompt_tokens.{context_mode}", num_prompt_tokens)
+
+    if cancelled and answer is not None:
+        # only bill the tokens produced before cancelling
+        sent_answer = answer
+        num_completion_tokens = openai_utils.num_tokens_from_string(answer, model)
     
     # TODO: consume tokens even if an exception occurs
     # consume tokens and append the message record to db
     if sent_answer is not None and num_completion_tokens is not None:
         if not disable_history:
             # update user data
-            new_dialog_message = {"user": message, "bot": sent_answer, "date": datetime.now(), "num_context_tokens": num_prompt_tokens, "num_completion_tokens": num_completion_tokens}
+            new_dialog_message = {"user": history_message or message, "bot": sent_answer, "date": datetime.now(), "num_context_tokens": num_prompt_tokens, "num_completion_tokens": num_completion_tokens}
             db.push_chat_messages(
                 chat_id,
                 new_dialog_message,
                 max_message_count,
             )
+            # fold older turns into the summary once the history is long
+            compaction.schedule(db, chat_id, user_id, model)
         else:
             db.update_chat_last_interaction(chat_id)
         final_cost = int(num_prompt_tokens * prompt_cost_factor + num_completion_tokens * completion_cost_factor)
+        if prepaid:
+            final_cost = 0
+        elif cached_answer is not None and precomputed_answer is None:
+            final_cost = answer_cache.billing_cost(num_prompt_tokens, num_completion_tokens, prompt_cost_factor, completion_cost_factor)
+        if answer_cache_key is not None and completed and (cached_answer is None or precomputed_answer is not None):
+            answer_cache.store(db, answer_cache_key, sent_answer, num_completion_tokens)
         # IMPORTANT: consume tokens in the end of function call to protect users' credits
         db.inc_user_used_tokens(user_id, final_cost)
+        metrics.inc("chat.turns")
+        metrics.inc("chat.prompt_tokens", num_prompt_tokens)
+        metrics.set_gauge("chat.avg_prompt_tokens", round(metrics.ratio("chat.prompt_tokens", "chat.turns")))
 
-        if voice_mode != "text":
+        if voice_mode != "text" and not cancelled:
             await send_voice_message(update, context, sent_answer, chat_mode_id, placeholder=voice_placeholder)
+    return sent_answer if completed else None
 
 async def send_voice_message(update: Update, context: CallbackContext, message: str, chat_mode: str, placeholder = None):
     if chat_mode not in config.TTS_MODELS:
@@ -648,19 +737,18 @@ async def send_voice_message(update: Update, context: CallbackContext, message:
         return
 
     if placeholder is None:
-        placeholder = await update.effective_message.reply_text("🗣 " + _("Recording ..."))
+        placeholder = await outbound.reply_text(update.effective_message, "🗣 " + _("Recording ..."))
 
     try:
         tts_model = config.TTS_MODELS[chat_mode]
-        filename = os.path.join(config.AUDIO_FILE_TMP_DIR, "{}-{}-{}.wav".format(chat_id, user.id, datetime.now()))
-        output = await tts_helper.tts(message, output=filename, model=tts_model)
-        if output:
-            seg = AudioSegment.from_wav(output)
+        seg = await tts_helper.tts(message, model=tts_model)
+        if seg:
             # recalculate real token amount
             estimated_cost = int(seg.duration_seconds * config.COQUI_TOKENS)
-            ogg_filename = os.path.splitext(output)[0] + ".ogg"
+            wav = io.BytesIO()
+            seg.export(wav, format="wav")
             # must use OPUS codec to show spectrogram on Telegram
-            seg.export(ogg_filename, format='ogg', codec="libopus")
+            voice = await audio_utils.wav_to_opus(wav.getvalue())
             try:
                 # in case the user deletes the placeholders manually
                 if placeholder is not None:
@@ -670,28 +758,46 @@ async def send_voice_message(update: Update, context: CallbackContext, message:
             
             cached_msg_id = db.cache_chat_message(full_message)
             reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(_("Text"), callback_data=ui.add_arg("show_message", "id", cached_msg_id))]])
-            await update.effective_message.reply_voice(ogg_filename, reply_markup=reply_markup)
+            await update.effective_message.reply_voice(voice, reply_markup=reply_markup)
             db.inc_user_used_tokens(user.id, estimated_cost)
             print(f"[TTS] real used tokens: {estimated_cost}")
-            # clean up
-            if os.path.exists(output):
-                os.remove(output)
-            if os.path.exists(ogg_filename):
-                os.remove(ogg_filename)
         else:
             text = "⚠️ " + _("The voice message could not be created. Voice messages are only valid in English.")
             try:
                 # in case the user deletes the placeholders manually
                 if placeholder is not None:
-                    await placeholder.edit_text(text)
+                    await outbound.edit_text(placeholder, text)
             except Exception as e:
                 print(e)
-                await update.effective_message.reply_text(text)
+                await outbound.reply_text(update.effective_message, text)
     except Exception as e:
         print(e)
         text = "⚠️ " + _("Failed to generate the voice message, please try again later.")
         text += " " + _("Reason: {}").format(e)
-        await update.effective_message.reply_text(text)
+        await outbound.reply_text(update.effective_message, text)
+
+def summary_prompt_pattern(url, _):
+    if helper.is_youtube_url(url):
+        return _("summarize the transcript from {} containing abstract, list of key points and the conclusion\n\ntranscript:\n{}")
+    return _("summarize the content from {} containing abstract, list of key points and the conclusion\n\noriginal content:\n{}")
+
+def speculate_summary(chat_id, user_id, chat_mode_id, system_prompt, model, url, content, _):
+    """Summarizes the ingested link in the background, most users ask for the summary next."""
+    if summarizer.needs_map_reduce(content):
+        # the parts are billed as they complete, only summarized on request
+        return
+    prompt_pattern = summary_prompt_pattern(url, _)
+    key = summarizer.cache_key(chat_mode_id, prompt_pattern, db.get_current_model(chat_id), content)
+    if config.ANSWER_CACHE_ENABLED and answer_cache.get(db, key) is not None:
+        return
+    message = prompt_pattern.format(url, content)
+    remaining_tokens = db.get_user_remaining_tokens(user_id)
+    num_tokens = openai_utils.num_tokens_from_string(system_prompt + " " + message, model)
+    model = chatgpt.resolve_model(model, num_tokens, chat_mode_id=chat_mode_id, remaining_tokens=remaining_tokens)
+    prompt, num_prompt_tokens = chatgpt.build_prompt(system_prompt, [], message, model)[:2]
+    if num_prompt_tokens * chatgpt.cost_factors(model)[0] > remaining_tokens:
+        return
+    summarizer.speculate(db, chat_id, user_id, key, prompt, model)
 
 async def summarize_handle(update: Update, context: CallbackContext):
     user = await register_user_if_not_exists(update, context)
@@ -701,12 +807,78 @@ async def summarize_handle(update: Update, context: CallbackContext):
     context_content, context_src = db.get_chat_context(chat_id)
     if helper.is_uri(context_src):
         url = context_src
-        if helper.is_youtube_url(context_src):
-            prompt_pattern = _("summarize the transcript from {} containing abstract, list of key points and the conclusion\n\ntranscript:\n{}")
-        else:
-            prompt_pattern = _("summarize the content from {} containing abstract, list of key points and the conclusion\n\noriginal content:\n{}")
-        message = prompt_pattern.format(url, context_content)
-        await message_handle(update, context, message, upscale=True)
+        prompt_pattern = summary_prompt_pattern(url, _)
+        model_id = db.get_current_model(chat_id)
+        # the chat mode message_handle answers with
+        chat_mode_id = db.get_current_chat_mode(chat_id)
+        if chat_mode_id not in helper.get_available_chat_modes(db, chat_id):
+            chat_mode_id = config.DEFAULT_CHAT_MODE
+        summary_key = summarizer.cache_key(chat_mode_id, prompt_pattern, model_id, context_content)
+        answer_cache_key = summary_key if config.ANSWER_CACHE_ENABLED else None
+        content = context_content
+        placeholder = None
+        precomputed_answer = await summarizer.take_speculative(chat_id, summary_key) if config.SPECULATIVE_SUMMARY else None
+        cached_answer = None
+        if precomputed_answer is None and answer_cache_key is not None:
+            cached_answer = answer_cache.get(db, answer_cache_key)
+        if summarizer.needs_map_reduce(context_content):
+            if precomputed_answer is not None or cached_answer is not None:
+                # nothing is generated, the prompt is only measured and priced from the partial summaries
+                content = summarizer.reduce_input(db, context_content)
+            else:
+                if not await check_balance(update, summarizer.estimated_cost(context_content), user):
+                    return
+                placeholder = await outbound.reply_text(update.effective_message, "📝 ...")
+
+                async def on_progress(num_done, num_parts):
+                    await outbound.edit_text(placeholder, f"📝 {num_done}/{num_parts} ...", final=False)
+
+                async def condense():
+                    try:
+                        return await summarizer.condense(db, user_id, context_content, on_progress)
+                    except asyncio.CancelledError:
+                        # stopped by /stop, /reset or switching chat modes
+                        await outbound.edit_text(placeholder, "📝 ...")
+                    except Exception as e:
+                        await send_openai_error(update, context, e, placeholder=placeholder)
+                    return None
+
+                # the parts are summarized first, /stop cancels them like any other generation
+                generation = asyncio.ensure_future(condense())
+                generations.register(chat_id, generation)
+                try:
+                    content = await generation
+                finally:
+                    generations.unregister(chat_id, generation)
+                if content is None:
+                    return
+                # the final summary is not left with what the parts took
+                deadline.start()
+        reply_markup = None
+        if config.CONTEXT_DISTILLATION:
+            reply_markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton(_("Ask about the full text"), callback_data="context_full")]
+            ])
+        # the partial summaries take the place of the content, the final summary is streamed as usual
+        message = prompt_pattern.format(url, content)
+        # the history only keeps the request, the content is already in the context
+        history_message = "{} {}".format(_("Summarize"), url)
+        answer = await message_handle(update, context, message, placeholder=placeholder, upscale=True, answer_cache_key=answer_cache_key, cached_answer=cached_answer, history_message=history_message, reply_markup=reply_markup, precomputed_answer=precomputed_answer)
+        if answer is not None:
+            db.set_chat_context_summary(chat_id, answer, "distilled" if config.CONTEXT_DISTILLATION else "full")
+
+async def context_full_handle(update: Update, context: CallbackContext):
+    user = await register_user_if_not_exists(update, context)
+    chat_id = update.effective_chat.id
+    _ = get_text_func(user, chat_id)
+    query = update.callback_query
+    await query.answer()
+
+    context_summary, context_mode = db.get_chat_context_summary(chat_id)
+    if context_summary is None:
+        return
+    db.set_chat_context_summary(chat_id, context_summary, "full")
+    await outbound.reply_text(update.effective_message, _("Follow-up questions will be answered from the full text, which costs more tokens."))
 
 async def image_message_handle(update: Update, context: CallbackContext):
     if update.edited_message is not None:
@@ -750,11 +922,11 @@ async def image_message_handle(update: Update, context: CallbackContext):
                     InlineKeyboardButton("💡 " + _("Learn"), url="https://t.me/sd_prompts_lab"),
                 ],
             ])
-            await update.effective_message.reply_text(text, ParseMode.HTML, reply_markup=reply_markup)
+            await outbound.reply_text(update.effective_message, text, ParseMode.HTML, reply_markup=reply_markup)
             return
         result = await openai_utils.moderation(message)
         if not result:
-            await update.effective_message.reply_text("⚠️ " + _("Inappropriate prompt. Please modify your prompt and retry."), ParseMode.HTML)
+            await outbound.reply_text(update.effective_message, "⚠️ " + _("Inappropriate prompt. Please modify your prompt and retry."), ParseMode.HTML)
             return
         path = "image"
     
@@ -796,7 +968,7 @@ async def gen_image_handle(update: Update, context: CallbackContext):
     
     remaing_time = db.is_user_generating_image(user_id)
     if remaing_time:
-        await update.effective_message.reply_text(_("⚠️ It is only possible to generate one image at a time. Please wait for {} seconds to retry.").format(int(remaing_time)), parse_mode=ParseMode.HTML)
+        await outbound.reply_text(update.effective_message, _("⚠️ It is only possible to generate one image at a time. Please wait for {} seconds to retry.").format(int(remaing_time)), parse_mode=ParseMode.HTML)
         return
     
     placeholder = None
@@ -804,9 +976,9 @@ async def gen_image_handle(update: Update, context: CallbackContext):
         db.mark_user_is_generating_image(user_id, True)
         text = _("👨‍🎨 painting ...")
         if update.effective_message.photo:
-            placeholder = await update.effective_message.reply_text(text)
+            placeholder = await outbound.reply_text(update.effective_message, text)
         else:
-            placeholder = await query.edit_message_text(text)
+            placeholder = await outbound.edit_message_text(query, text)
 
         result = await gen_image_utils.inference(model=model, width=width, height=height, prompt=prompt)
         try:
@@ -883,19 +1055,19 @@ async def upscale_image_handle(update: Update, context: CallbackContext):
         reply_markup = InlineKeyboardMarkup([
             [InlineKeyboardButton(_("Upscale - {} tokens").format(config.UPSCALE_COST), callback_data=callback_data),]
         ])
-        await update.effective_message.reply_text(text, reply_markup=reply_markup, reply_to_message_id=update.effective_message.message_id)
+        await outbound.reply_text(update.effective_message, text, reply_markup=reply_markup, reply_to_message_id=update.effective_message.message_id)
         return
         
     try:
         remaing_time = db.is_user_generating_image(user_id)
         if remaing_time:
-            await update.effective_message.reply_text(_("⚠️ It is only possible to generate one image at a time. Please wait for {} seconds to retry.").format(int(remaing_time)), parse_mode=ParseMode.HTML)
+            await outbound.reply_text(update.effective_message, _("⚠️ It is only possible to generate one image at a time. Please wait for {} seconds to retry.").format(int(remaing_time)), parse_mode=ParseMode.HTML)
             return
         
         db.mark_user_is_generating_image(user_id, True)
         args = json.loads(cached_data)
         text = _("👨‍🎨 painting ...")
-        placeholder = await query.edit_message_text(text)
+        placeholder = await outbound.edit_message_text(query, text)
         photo = helper.get_original_photo(update.effective_message.reply_to_message.photo)
         photo_file = await context.bot.get_file(photo.file_id)
         buffer = await photo_file.download_as_bytearray()
@@ -943,6 +1115,14 @@ async def show_message_handle(update: Update, context: CallbackContext):
 async def reset_handle(update: Update, context: CallbackContext):
     await set_chat_mode(update, context, reason="reset")
 
+async def stop_handle(update: Update, context: CallbackContext):
+    user = await register_user_if_not_exists(update, context)
+    chat_id = update.effective_chat.id
+    _ = get_text_func(user, chat_id)
+
+    if not await generations.cancel(chat_id):
+        await outbound.reply_text(update.message, _("💡 No answer is being generated"))
+
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
     user = await register_user_if_not_exists(update, context)
     user_id = update.message.from_user.id
@@ -951,7 +1131,7 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
     _ = get_text_func(user, chat_id)
 
     text, reply_markup = ui.settings(db, chat_id, _, "settings>current_chat_mode")
-    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    await outbound.reply_text(update.message, text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
 async def set_chat_model(update: Update, context: CallbackContext, model = None):
     user = await register_user_if_not_exists(update, context)
@@ -980,7 +1160,7 @@ async def set_chat_model(update: Update, context: CallbackContext, model = None)
     if keyborad_rows:
         reply_markup = InlineKeyboardMarkup(keyborad_rows)
 
-    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    await outbound.reply_text(update.message, text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
 async def set_chat_mode(update: Update, context: CallbackContext, chat_mode_id = None, reason: str = None):
     user = await register_user_if_not_exists(update, context)
@@ -988,6 +1168,10 @@ async def set_chat_mode(update: Update, context: CallbackContext, chat_mode_id =
     chat_id = update.effective_chat.id
     _ = get_text_func(user, chat_id)
 
+    # stop the answer and the compaction of the previous conversation
+    await generations.cancel(chat_id)
+    compaction.cancel(chat_id)
+
     if chat_mode_id is None:
         chat_mode = helper.get_current_chat_mode(db, chat_id)
         chat_mode_id = chat_mode["id"]
@@ -1152,7 +1336,8 @@ async def show_payment_methods(update: Update, context: CallbackContext):
         [InlineKeyboardButton(_("💎 Crypto"), callback_data=f"payment|crypto|{amount}|{tokens_amount}")]
     ])
 
-    await query.edit_message_text(
+    await outbound.edit_message_text(
+        query,
         text,
         parse_mode=ParseMode.HTML,
         reply_markup=reply_markup
@@ -1171,7 +1356,8 @@ async def show_invoice(update: Update, context: CallbackContext):
     amount = float(amount)
     token_amount = int(float(token_amount))
 
-    await query.edit_message_text(
+    await outbound.edit_message_text(
+        query,
         _("📋 Creating an invoice ..."),
         parse_mode=ParseMode.HTML,
     )
@@ -1208,7 +1394,8 @@ async def show_invoice(update: Update, context: CallbackContext):
         text = _("⚠️ Failed to create an invoice, please try again later.")
         reply_markup = None
 
-    await query.edit_message_text(
+    await outbound.edit_message_text(
+        query,
         text,
         parse_mode=ParseMode.HTML,
         reply_markup=reply_markup
@@ -1268,7 +1455,7 @@ async def edited_message_handle(update: Update, context: CallbackContext):
     _ = get_text_func(user, chat_id)
 
     text = _("💡 Edited messages won't take effects")
-    await update.edited_message.reply_text(text, parse_mode=ParseMode.HTML)
+    await outbound.reply_text(update.edited_message, text, parse_mode=ParseMode.HTML)
 
 async def error_handle(update: Update, context: CallbackContext) -> None:
     # collect error message
@@ -1304,6 +1491,13 @@ async def app_post_init(application: Application):
     # setup bot commands
     await application.bot.set_my_commands(get_commands())
     await application.bot.set_my_commands(get_commands('zh_CN'), language_code="zh")
+    db.ensure_indexes()
+    await http_client.start()
+    application.create_task(metrics.report_periodically())
+
+async def app_post_shutdown(application: Application):
+    await http_client.close()
+    web_fetch.close()
 
 def run_bot() -> None:
     application = (
@@ -1311,6 +1505,7 @@ def run_bot() -> None:
         .token(config.TELEGRAM_BOT_TOKEN)
         .concurrent_updates(True)
         .post_init(app_post_init)
+        .post_shutdown(app_post_shutdown)
         .build()
     )
 
@@ -1323,6 +1518,7 @@ def run_bot() -> None:
     application.add_handler(CommandHandler("start", start_handle, filters=user_filter))
     application.add_handler(CommandHandler("reset", reset_handle, filters=user_filter))
     application.add_handler(CallbackQueryHandler(reset_handle, pattern="^reset"))
+    application.add_handler(CommandHandler("stop", stop_handle, filters=user_filter))
     # application.add_handler(CommandHandler("role", show_chat_modes_handle, filters=user_filter))
     application.add_handler(CallbackQueryHandler(set_chat_mode_handle, pattern="^set_chat_mode"))
     application.add_handler(CommandHandler("balance", show_balance_handle, filters=user_filter))
@@ -1330,23 +1526,26 @@ def run_bot() -> None:
     application.add_handler(CallbackQueryHandler(show_payment_methods, pattern="^top_up\|(\d)+"))
     application.add_handler(CallbackQueryHandler(show_invoice, pattern="^payment\|"))
     application.add_handler(CommandHandler("earn", show_earn_handle, filters=user_filter))
-    application.add_handler(CommandHandler("gpt", common_command_handle, filters=user_filter))
-    application.add_handler(CommandHandler("gpt4", common_command_handle, filters=user_filter))
-    application.add_handler(CommandHandler("chatgpt", common_command_handle, filters=user_filter))
-    application.add_handler(CommandHandler("proofreader", common_command_handle, filters=user_filter))
-    application.add_handler(CommandHandler("dictionary", common_command_handle, filters=user_filter))
-    application.add_handler(CallbackQueryHandler(common_command_handle, pattern="^retry"))
-    application.add_handler(CallbackQueryHandler(summarize_handle, pattern="^summarize"))
-    application.add_handler(CommandHandler("image", image_message_handle, filters=user_filter))
-    application.add_handler(CallbackQueryHandler(image_message_handle, pattern="^image"))
-    application.add_handler(CallbackQueryHandler(gen_image_handle, pattern="^gen_image"))
-    application.add_handler(CallbackQueryHandler(upscale_image_handle, pattern="^upscale"))
+    # answers of the same chat are generated in order
+    command_handle = serialized(common_command_handle, preempt=is_bare_command)
+    application.add_handler(CommandHandler("gpt", command_handle, filters=user_filter))
+    application.add_handler(CommandHandler("gpt4", command_handle, filters=user_filter))
+    application.add_handler(CommandHandler("chatgpt", command_handle, filters=user_filter))
+    application.add_handler(CommandHandler("proofreader", command_handle, filters=user_filter))
+    application.add_handler(CommandHandler("dictionary", command_handle, filters=user_filter))
+    application.add_handler(CallbackQueryHandler(serialized(common_command_handle), pattern="^retry"))
+    application.add_handler(CallbackQueryHandler(serialized(summarize_handle), pattern="^summarize"))
+    application.add_handler(CallbackQueryHandler(context_full_handle, pattern="^context_full"))
+    application.add_handler(CommandHandler("image", deadline.scoped(image_message_handle), filters=user_filter))
+    application.add_handler(CallbackQueryHandler(deadline.scoped(image_message_handle), pattern="^image"))
+    application.add_handler(CallbackQueryHandler(deadline.scoped(gen_image_handle), pattern="^gen_image"))
+    application.add_handler(CallbackQueryHandler(deadline.scoped(upscale_image_handle), pattern="^upscale"))
     application.add_handler(CallbackQueryHandler(show_message_handle, pattern="^show_message"))
     application.add_handler(CommandHandler("settings", settings_handle, filters=user_filter))
     application.add_handler(CallbackQueryHandler(settings_handle, pattern="^(settings|about)"))
     application.add_handler(CallbackQueryHandler(close_handle, pattern="^close"))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter, message_handle))
-    application.add_handler(MessageHandler(filters.VOICE & user_filter, voice_message_handle))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter, serialized(message_handle)))
+    application.add_handler(MessageHandler(filters.VOICE & user_filter, serialized(voice_message_handle)))
     application.add_error_handler(error_handle)
     
     # start the bot
@@ -0,0 +1,99 @@
+import json
+import time
+import asyncio
+
+import aiohttp
+import openai
+
+import metrics
+import key_pool
+import http_client
+
+# streams chat completions over SSE without the openai client objects, each delta is a (content, finish_reason) tuple
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+DATA_PREFIX = b"data:"
+DONE = b"[DONE]"
+
+def request_url(credential: key_pool.Credential, model: str):
+    if credential.api_type == "azure":
+        return "{}/openai/deployments/{}/chat/completions?api-version={}".format(credential.api_base.rstrip("/"), model, credential.api_version)
+    return "{}/chat/completions".format((credential.api_base or openai.api_base or OPENAI_API_BASE).rstrip("/"))
+
+def request_headers(credential: key_pool.Credential):
+    if credential.api_type == "azure":
+        return {"api-key": credential.api_key}
+    headers = {"Authorization": f"Bearer {credential.api_key}"}
+    if openai.organization:
+        headers["OpenAI-Organization"] = openai.organization
+    return headers
+
+def _error(status: int, body: bytes, headers):
+    """Maps an error response to the openai exceptions, the rest of the bot already handles them."""
+    try:
+        json_body = json.loads(body)
+        error = json_body.get("error") or {}
+    except ValueError:
+        json_body = None
+        error = {}
+    message = error.get("message") or body.decode(errors="replace") or f"HTTP {status}"
+    args = dict(http_body=body, http_status=status, json_body=json_body, headers=headers)
+    if status == 429:
+        return openai.error.RateLimitError(message, **args)
+    if status == 401:
+        return openai.error.AuthenticationError(message, **args)
+    if status == 403:
+        return openai.error.PermissionError(message, **args)
+    if status in (400, 404, 409, 415):
+        return openai.error.InvalidRequestError(message, error.get("param"), code=error.get("code"), **args)
+    if status == 503:
+        return openai.error.ServiceUnavailableError(message, **args)
+    return openai.error.APIError(message, **args)
+
+def parse_event(line: bytes):
+    """Parses a SSE line, returns the (content, finish_reason) delta, None for other lines and DONE at the end."""
+    if not line.startswith(DATA_PREFIX):
+        # blank separators, comments and other fields
+        return None
+    data = line[len(DATA_PREFIX):].strip()
+    if data == DONE:
+        return DONE
+    event = json.loads(data)
+    choices = event.get("choices")
+    if not choices:
+        # e.g. Azure prompt filter results
+        return None
+    choice = choices[0]
+    delta = choice.get("delta") or {}
+    return delta.get("content"), choice.get("finish_reason")
+
+async def stream_chat(prompt, model, max_tokens=None, credential: key_pool.Credential = None, api_type=None):
+    """Streams the completion of the prompt, yields (content, finish_reason) tuples."""
+    if credential is None:
+        credential = key_pool.acquire(api_type, max_tokens or 0)
+
+    body = {"messages": prompt, "stream": True}
+    if max_tokens is not None:
+        body["max_tokens"] = max_tokens
+    if credential.api_type != "azure":
+        body["model"] = model
+
+    start_time = time.monotonic()
+    try:
+        async with http_client.get("openai").post(request_url(credential, model), json=body, headers=request_headers(credential)) as response:
+            if response.status != 200:
+                raise _error(response.status, await response.read(), response.headers)
+            metrics.observe("chat.connect", time.monotonic() - start_time)
+            async for line in response.content:
+                delta = parse_event(line)
+                if delta is DONE:
+                    break
+                if delta is not None:
+                    yield delta
+    except openai.error.OpenAIError as e:
+        key_pool.report_error(credential, e)
+        raise
+    except asyncio.TimeoutError:
+        raise openai.error.Timeout("Request timed out")
+    except aiohttp.ClientError as e:
+        raise openai.error.APIConnectionError(f"Error communicating with OpenAI: {e}")
@@ -1,6 +1,12 @@
+import time
+import asyncio
+
 import openai_utils
+import chat_client
 import config
-import asyncio
+import metrics
+import key_pool
+import deadline
 
 MIN_TOKENS = 30
 
@@ -9,15 +15,73 @@ def _model_name(model, api_type):
         return model.replace(".", "")
     return model
 
-def resolve_model(model, num_prompt_tokens:int):
-    original_model = model
-    max_tokens = openai_utils.max_context_tokens(model)
-    # if model == openai_utils.MODEL_GPT_4 and num_prompt_tokens > max_tokens:
-    #     model = openai_utils.MODEL_GPT_4_32K
-    print(f"resolve_model {original_model} > {model}, num_tokens={num_prompt_tokens}")
-    return model
-    
-def build_prompt(system_prompt, dialog_messages, new_message, model, max_tokens: int = None):
+# models a choice of the user can be routed to, the first one is the default
+MODEL_TIERS = {
+    openai_utils.MODEL_GPT_35_TURBO: [openai_utils.MODEL_GPT_35_TURBO],
+    openai_utils.MODEL_GPT_4: [openai_utils.MODEL_GPT_4, openai_utils.MODEL_GPT_4_TURBO],
+}
+# expected seconds to the first token until enough samples are collected
+LATENCY_PRIORS = {
+    openai_utils.MODEL_GPT_35_TURBO: 0.8,
+    openai_utils.MODEL_GPT_4: 2.0,
+    openai_utils.MODEL_GPT_4_TURBO: 1.5,
+}
+# short prompts of these chat modes are routed to the fastest model
+FAST_CHAT_MODES = set(["dictionary"])
+
+def _expected_latency(model):
+    latencies = metrics.window(f"chat.first_token.{model}")
+    if len(latencies) < config.ROUTER_MIN_SAMPLES:
+        return LATENCY_PRIORS.get(model, config.ROUTER_OVERLOAD_LATENCY)
+    return latencies.percentile(50)
+
+def _is_overloaded(model):
+    latencies = metrics.window(f"chat.first_token.{model}")
+    if len(latencies) >= config.ROUTER_MIN_SAMPLES and latencies.percentile(95) > config.ROUTER_OVERLOAD_LATENCY:
+        return True
+    errors = metrics.window(f"chat.errors.{model}")
+    return len(errors) >= config.ROUTER_MIN_SAMPLES and errors.mean() > config.ROUTER_MAX_ERROR_RATE
+
+def default_model(model):
+    """The model of the tier used unless the prompt doesn't fit it."""
+    return MODEL_TIERS.get(model, [model])[0]
+
+def resolve_model(model, num_prompt_tokens: int, chat_mode_id: str = None, remaining_tokens: int = None):
+    """Routes the request to a model of the tier the user chose, by prompt size, chat mode, balance and model health."""
+    tier = MODEL_TIERS.get(model, [model])
+    fitting = [m for m in tier if openai_utils.max_context_tokens(m) >= num_prompt_tokens + MIN_TOKENS]
+    if not fitting:
+        # the caller reports the prompt as too long
+        resolved, reason = max(tier, key=openai_utils.max_context_tokens), "too_long"
+    else:
+        healthy = [m for m in fitting if not _is_overloaded(m)] or fitting
+        if remaining_tokens is not None and remaining_tokens < config.ROUTER_LOW_BALANCE:
+            resolved, reason = min(healthy, key=lambda m: sum(cost_factors(m))), "low_balance"
+        elif chat_mode_id in FAST_CHAT_MODES and num_prompt_tokens <= config.ROUTER_FAST_MAX_TOKENS:
+            resolved, reason = min(healthy, key=_expected_latency), "fast"
+        else:
+            resolved = healthy[0]
+            if resolved == tier[0]:
+                reason = "default"
+            elif tier[0] not in fitting:
+                reason = "long_context"
+            else:
+                reason = "overloaded"
+    metrics.inc(f"router.{reason}")
+    print(f"resolve_model {model} > {resolved}, reason={reason}, num_tokens={num_prompt_tokens}, chat_mode={chat_mode_id}")
+    return resolved
+
+def _record_outcome(model, start_time, first_token_time=None, error: Exception = None, num_completion_tokens: int = None):
+    """Feeds the model health used by resolve_model and logs the outcome of the routing decision."""
+    metrics.observe(f"chat.errors.{model}", 1 if error is not None else 0)
+    elapsed = time.monotonic() - start_time
+    if error is not None:
+        print(f"route outcome {model}: {type(error).__name__} after {elapsed:.2f}s")
+        return
+    first_token = f"{first_token_time - start_time:.2f}s" if first_token_time is not None else "-"
+    print(f"route outcome {model}: first_token={first_token}, total={elapsed:.2f}s, num_completion_tokens={num_completion_tokens}")
+
+def build_prompt(system_prompt, dialog_messages, new_message, model, max_tokens: int = None, summary: str = None):
     n_dialog_messages_before = len(dialog_messages)
     n_first_dialog_messages_removed = 0
     prompt = None
@@ -29,7 +93,7 @@ def build_prompt(system_prompt, dialog_messages, new_message, model, max_tokens:
             # forget first message in dialog_messages
             dialog_messages = dialog_messages[1:]
             n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-        prompt = openai_utils.prompt_from_chat_messages(system_prompt, dialog_messages, new_message, model)
+        prompt = openai_utils.prompt_from_chat_messages(system_prompt, dialog_messages, new_message, model, summary=summary)
         num_prompt_tokens = openai_utils.num_tokens_from_messages(prompt, model)
         # retain the first message from context
         if len(dialog_messages) < 1:
@@ -39,10 +103,105 @@ def build_prompt(system_prompt, dialog_messages, new_message, model, max_tokens:
 def cost_factors(model):
     if model == openai_utils.MODEL_GPT_4:
         return 10, 15
+    elif model == openai_utils.MODEL_GPT_4_TURBO:
+        return 4, 8
     # elif model == openai_utils.MODEL_GPT_4_32K:
     #     return 20, 20
     return 0.5, 1
 
+def _alternate_credential(credential: key_pool.Credential, num_tokens: int):
+    # prefer the other backend, then another key of the same backend
+    if config.AZURE_OPENAI_API_BASE and config.AZURE_OPENAI_API_VERSION and config.AZURE_OPENAI_API_KEY:
+        api_type = config.DEFAULT_OPENAI_API_TYPE if credential.api_type == "azure" else "azure"
+        if len(key_pool.get_pool(api_type)):
+            return key_pool.acquire(api_type, num_tokens)
+    return key_pool.acquire(credential.api_type, num_tokens, exclude=credential)
+
+def _hedge_delay():
+    latencies = metrics.window("chat.first_token")
+    if len(latencies) < config.HEDGE_MIN_SAMPLES:
+        return config.HEDGE_MAX_DELAY
+    delay = latencies.percentile(config.HEDGE_PERCENTILE)
+    return min(max(delay, config.HEDGE_MIN_DELAY), config.HEDGE_MAX_DELAY)
+
+def _update_hedge_rate():
+    metrics.set_gauge("chat.hedge_rate", round(metrics.ratio("chat.hedged", "chat.requests"), 4))
+
+async def _close_stream(r):
+    try:
+        await r.aclose()
+    except Exception as e:
+        print(f"failed to close stream: {e}")
+
+async def _open_stream(prompt, model, max_tokens, credential: key_pool.Credential):
+    """Opens a streaming request and reads until the first token, returns the stream and the chunks read so far."""
+    start_time = time.monotonic()
+    api_type = credential.api_type
+    r = chat_client.stream_chat(prompt, _model_name(model, api_type), max_tokens=max_tokens, credential=credential)
+    buffered = []
+    try:
+        async for delta in r:
+            buffered.append(delta)
+            content_delta, finish_reason = delta
+            if content_delta or finish_reason:
+                break
+    except BaseException:
+        await _close_stream(r)
+        raise
+    metrics.observe("chat.first_token", time.monotonic() - start_time)
+    metrics.observe(f"chat.first_token.{model}", time.monotonic() - start_time)
+    return r, buffered
+
+async def _open_hedged_stream(prompt, model, max_tokens, api_type, num_tokens):
+    metrics.inc("chat.requests")
+    _update_hedge_rate()
+    credential = key_pool.acquire(api_type, num_tokens)
+    if not config.HEDGE_ENABLED:
+        return await _open_stream(prompt, model, max_tokens, credential)
+
+    primary = asyncio.ensure_future(_open_stream(prompt, model, max_tokens, credential))
+    pending = {primary}
+    winner = None
+    error = None
+    try:
+        done, pending = await asyncio.wait(pending, timeout=_hedge_delay())
+        if done:
+            return primary.result()
+
+        # the hedge is only charged for the prompt if it wins
+        alternate = _alternate_credential(credential, 0)
+        if alternate is None:
+            return await primary
+
+        # the first token is late, race against the alternate backend or key
+        metrics.inc("chat.hedged")
+        _update_hedge_rate()
+        print(f"hedging {model} request from {credential.name} to {alternate.name}")
+        hedge = asyncio.ensure_future(_open_stream(prompt, model, max_tokens, alternate))
+        pending = {primary, hedge}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task
+                else:
+                    # both finished at the same time, drop the loser
+                    await _close_stream(task.result()[0])
+    finally:
+        # cancel the loser, it closes its own stream
+        for task in pending:
+            task.cancel()
+
+    if winner is None:
+        raise error
+    if winner is hedge:
+        metrics.inc("chat.hedge_wins")
+        credential.refund(num_tokens)
+        alternate.record(num_tokens, request=False)
+    return winner.result()
+
 async def send_message(prompt, model=openai_utils.MODEL_GPT_35_TURBO, max_tokens=None, stream=False, api_type=None):
     num_prompt_tokens = openai_utils.num_tokens_from_messages(prompt, model)
     max_output_tokens = openai_utils.max_output_tokens(model, num_context_tokens=num_prompt_tokens)
@@ -52,33 +211,56 @@ async def send_message(prompt, model=openai_utils.MODEL_GPT_35_TURBO, max_tokens
     answer = None
     finish_reason = None
 
-    r = await openai_utils.create_request(prompt, _model_name(model, api_type), max_tokens=max_tokens, stream=stream, api_type=api_type)
+    start_time = time.monotonic()
+    first_token_time = None
+    try:
+        if stream:
+            # the deadline covers the time to the first token, gaps between chunks are limited by the session
+            r, buffered = await deadline.run("chat", _open_hedged_stream(prompt, model, max_tokens, api_type, num_prompt_tokens + max_tokens))
+            first_token_time = time.monotonic()
 
-    if stream:
-        async for buffer in r:
-            content_delta, finish_reason = openai_utils.reply_content(buffer, model, stream=True)
-            if not content_delta:
-                continue
-            if answer is None:
-                answer = content_delta
-            else:
-                answer += content_delta
+            async def replay():
+                for delta in buffered:
+                    yield delta
+                async for delta in r:
+                    yield delta
 
-            if model == openai_utils.MODEL_GPT_4:
-                # WORKAROUND: avoid reaching rate limit
-                await asyncio.sleep(0.1)
-            yield False, answer, None
-    else:
-        answer = openai_utils.reply_content(r, model)
+            try:
+                async for content_delta, finish_reason in replay():
+                    if not content_delta:
+                        continue
+                    if answer is None:
+                        answer = content_delta
+                    else:
+                        answer += content_delta
 
-    num_completion_tokens = openai_utils.num_tokens_from_string(answer, model) if answer is not None else 0
-    num_total_tokens = num_prompt_tokens + num_completion_tokens
+                    if model == openai_utils.MODEL_GPT_4:
+                        # WORKAROUND: avoid reaching rate limit
+                        await asyncio.sleep(0.1)
+                    yield False, answer, None
+            finally:
+                await _close_stream(r)
+        else:
+            credential = key_pool.acquire(api_type, num_prompt_tokens + max_tokens)
+            r = await openai_utils.create_request(prompt, _model_name(model, api_type), max_tokens=max_tokens, stream=stream, api_type=api_type, credential=credential)
+            answer = openai_utils.reply_content(r, model)
+            first_token_time = time.monotonic()
 
-    if answer is None:
-        print(f"Invalid answer, num_prompt_tokens={num_prompt_tokens}, num_completion_tokens={num_completion_tokens}, finish_reason={finish_reason}")
-        raise Exception(finish_reason)
+        num_completion_tokens = openai_utils.num_tokens_from_string(answer, model) if answer is not None else 0
+        num_total_tokens = num_prompt_tokens + num_completion_tokens
+
+        if answer is None:
+            print(f"Invalid answer, num_prompt_tokens={num_prompt_tokens}, num_completion_tokens={num_completion_tokens}, finish_reason={finish_reason}")
+            raise Exception(finish_reason)
+    except Exception as e:
+        _record_outcome(model, start_time, error=e)
+        raise
+    _record_outcome(model, start_time, first_token_time, num_completion_tokens=num_completion_tokens)
 
     # TODO: handle finish_reason == "length"
 
     yield True, answer, num_completion_tokens
-        
\ No newline at end of file
+
+async def replay_answer(answer: str, num_completion_tokens: int):
+    """Streams a precomputed answer in the same format as send_message."""
+    yield True, answer, num_completion_tokens
@@ -0,0 +1,67 @@
+import zlib
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import config
+
+# large text fields are stored as compressed binary, short ones stay strings so existing documents read unchanged
+
+# first byte of the stored binary
+ZLIB = b"\x01"
+ZSTD = b"\x02"
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# zstandard contexts are not thread safe
+_local = threading.local()
+
+def _zstd_compressor():
+    if not hasattr(_local, "compressor"):
+        _local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return _local.compressor
+
+def _zstd_decompressor():
+    if not hasattr(_local, "decompressor"):
+        _local.decompressor = zstandard.ZstdDecompressor()
+    return _local.decompressor
+
+def encode(text: str):
+    """Returns the text compressed as bytes if it's large enough and worth it, otherwise the text itself."""
+    if not config.STORAGE_COMPRESSION or not isinstance(text, str) or len(text) < config.STORAGE_COMPRESSION_MIN_BYTES:
+        return text
+    data = text.encode()
+    if zstandard is not None:
+        compressed = ZSTD + _zstd_compressor().compress(data)
+    else:
+        compressed = ZLIB + zlib.compress(data, ZLIB_LEVEL)
+    if len(compressed) >= len(data):
+        return text
+    return compressed
+
+def decode(value):
+    """Inverse of encode, strings and None are returned as they are."""
+    if not isinstance(value, (bytes, bytearray)):
+        return value
+    tag, data = value[:1], value[1:]
+    if tag == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read the stored data")
+        return _zstd_decompressor().decompress(data).decode()
+    if tag == ZLIB:
+        return zlib.decompress(data).decode()
+    raise ValueError(f"unknown codec {tag!r}")
+
+def encode_message(message: dict):
+    """Copy of the dialog message with its texts encoded."""
+    return {**message, "user": encode(message["user"]), "bot": encode(message["bot"])}
+
+def decode_message(message: dict):
+    return {**message, "user": decode(message["user"]), "bot": decode(message["bot"])}
+
+def decode_messages(messages: list):
+    return [decode_message(m) for m in messages] if messages is not None else None
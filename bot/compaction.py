@@ -0,0 +1,77 @@
+import asyncio
+
+import config
+import metrics
+import deadline
+import openai_utils
+import chatgpt
+from database import Database
+
+# folds the older turns of long conversations into a running summary stored with the chat
+
+SUMMARY_PROMPT = """Summarize the conversation between the user and the assistant below, extending the previous summary if any.
+Keep the facts, names, numbers, decisions, open questions and the language of the conversation. Be concise and write in third person."""
+
+# compaction task of each chat
+_tasks = {}
+
+def _format_turns(messages: list):
+    return "\n\n".join("User: {}\nAssistant: {}".format(m["user"], m["bot"]) for m in messages)
+
+def num_history_tokens(messages: list, summary: str, model: str):
+    text = _format_turns(messages)
+    if summary:
+        text = summary + "\n\n" + text
+    return openai_utils.num_tokens_from_string(text, model)
+
+def schedule(db: Database, chat_id: int, user_id: int, model: str):
+    """Starts folding the older turns of the chat in the background once its history is too long."""
+    if not config.COMPACTION_ENABLED:
+        return
+    task = _tasks.get(chat_id)
+    if task is not None and not task.done():
+        return
+    messages, summary = db.get_chat_messages_and_summary(chat_id)
+    if not messages or len(messages) <= config.COMPACTION_KEEP_MESSAGES:
+        return
+    if num_history_tokens(messages, summary, model) < config.COMPACTION_THRESHOLD:
+        return
+    task = asyncio.ensure_future(_compact(db, chat_id, user_id, messages, summary))
+    _tasks[chat_id] = task
+    task.add_done_callback(lambda t: _tasks.pop(chat_id, None) if _tasks.get(chat_id) is t else None)
+
+def cancel(chat_id: int):
+    task = _tasks.pop(chat_id, None)
+    if task is not None and not task.done():
+        task.cancel()
+
+async def _compact(db: Database, chat_id: int, user_id: int, messages: list, summary: str):
+    # not bound by the deadline of the update which scheduled it
+    deadline.start()
+    folded = messages[:-config.COMPACTION_KEEP_MESSAGES]
+    if any("date" not in m for m in folded):
+        # the stored turns are identified by their date
+        return
+    model = config.COMPACTION_MODEL
+    content = _format_turns(folded)
+    if summary:
+        content = "Previous summary:\n{}\n\nConversation:\n{}".format(summary, content)
+    prompt = openai_utils.chatgpt_prompt(SUMMARY_PROMPT, [], content)
+    try:
+        with metrics.timer("compaction.latency"):
+            async for finished, answer, num_completion_tokens in chatgpt.send_message(prompt, model=model, max_tokens=config.COMPACTION_SUMMARY_MAX_TOKENS, api_type=config.OPENAI_CHAT_API_TYPE):
+                pass
+    except Exception as e:
+        metrics.inc("compaction.errors")
+        print(f"failed to compact chat {chat_id}: {e}")
+        return
+
+    if not db.fold_chat_messages(chat_id, summary, answer, [m["date"] for m in folded]):
+        # the chat was reset or compacted meanwhile
+        return
+    num_prompt_tokens = openai_utils.num_tokens_from_messages(prompt, model)
+    prompt_cost_factor, completion_cost_factor = chatgpt.cost_factors(model)
+    db.inc_user_used_tokens(user_id, int(num_prompt_tokens * prompt_cost_factor + num_completion_tokens * completion_cost_factor))
+    metrics.inc("compaction.runs")
+    metrics.inc("compaction.folded_messages", len(folded))
+    print(f"compacted {len(folded)} messages of chat {chat_id}, summary tokens={num_completion_tokens}")
@@ -77,6 +77,12 @@ def _env_parse_float(name, default_value = None):
             raise Exception(f"{name} isn't an number")
     return value if value else default_value
 
+def _env_parse_bool(name, default_value = False):
+    value = os.getenv(name)
+    if value:
+        return value.lower() in ("1", "true", "yes", "on")
+    return default_value
+
 def _env_parse_str_array(name, default_value = None):
     value = os.getenv(name, default_value)
     if value:
@@ -132,7 +138,8 @@ TTS_MODELS = {}
 # TTS models
 if os.getenv('TTS_MODELS'):
     TTS_MODELS = { **TTS_MODELS, **load_tts_models(os.getenv('TTS_MODELS')) }
-AUDIO_FILE_TMP_DIR = 'tmp/voice'
+# voice audio is kept in memory, larger buffers spill to a temporary file
+AUDIO_SPOOL_MAX_BYTES = _env_parse_int('AUDIO_SPOOL_MAX_BYTES', 8 * 1024 * 1024)
 
 SUPPORT_USER_NAME = "nexia_support"
 TELEGRAM_BOT_NAME = os.getenv('TELEGRAM_BOT_NAME')
@@ -151,12 +158,115 @@ AZURE_OPENAI_API_KEY = os.getenv('AZURE_OPENAI_API_KEY')
 if not AZURE_OPENAI_API_BASE or not AZURE_OPENAI_API_VERSION or not AZURE_OPENAI_API_KEY:
     # fallback to official OpenAI base if Azure is not set up properly
     OPENAI_CHAT_API_TYPE = DEFAULT_OPENAI_API_TYPE
+# additional API keys to spread requests across organizations
+OPENAI_API_KEYS = _env_parse_str_array('OPENAI_API_KEYS') or []
+# additional Azure keys, `key` or `api_base|key` for other Azure resources
+AZURE_OPENAI_API_KEYS = _env_parse_str_array('AZURE_OPENAI_API_KEYS') or []
+# per key quotas in requests and tokens per minute
+OPENAI_KEY_RPM = _env_parse_int('OPENAI_KEY_RPM', 3500)
+OPENAI_KEY_TPM = _env_parse_int('OPENAI_KEY_TPM', 90000)
+# fold older turns into a running summary once the history exceeds the threshold in tokens,
+# off by default, the summaries are generated in the background and billed to the user like answers
+COMPACTION_ENABLED = _env_parse_bool('COMPACTION_ENABLED', False)
+COMPACTION_THRESHOLD = _env_parse_int('COMPACTION_THRESHOLD', 3000)
+# number of recent messages kept verbatim
+COMPACTION_KEEP_MESSAGES = _env_parse_int('COMPACTION_KEEP_MESSAGES', 4)
+COMPACTION_SUMMARY_MAX_TOKENS = 600
+COMPACTION_MODEL = "gpt-3.5-turbo-1106"
+# answer questions about long link contexts with the relevant chunks only, sizes in tokens
+RETRIEVAL_ENABLED = _env_parse_bool('RETRIEVAL_ENABLED', True)
+# smaller documents are always sent in full
+RETRIEVAL_MIN_TOKENS = _env_parse_int('RETRIEVAL_MIN_TOKENS', 3000)
+RETRIEVAL_BUDGET = _env_parse_int('RETRIEVAL_BUDGET', 2000)
+RETRIEVAL_CHUNK_TOKENS = 250
+RETRIEVAL_TOP_K = 8
+# content longer than a single prompt is summarized part by part concurrently, sizes in tokens
+SUMMARY_SINGLE_PASS_TOKENS = _env_parse_int('SUMMARY_SINGLE_PASS_TOKENS', 12000)
+SUMMARY_CHUNK_TOKENS = _env_parse_int('SUMMARY_CHUNK_TOKENS', 6000)
+# max number of parts summarized at the same time for one document
+SUMMARY_CONCURRENCY = _env_parse_int('SUMMARY_CONCURRENCY', 4)
+# seconds the parts of one document may take, the final summary then gets a full UPDATE_DEADLINE
+SUMMARY_MAP_DEADLINE = _env_parse_int('SUMMARY_MAP_DEADLINE', 600)
+SUMMARY_PART_MAX_TOKENS = 500
+SUMMARY_MAX_RETRIES = 2
+SUMMARY_MODEL = "gpt-3.5-turbo-1106"
+# longer YouTube transcripts are sampled evenly across the video, in tokens
+TRANSCRIPT_MAX_TOKENS = _env_parse_int('TRANSCRIPT_MAX_TOKENS', 50000)
+# web pages are cut at this size in bytes
+WEB_FETCH_MAX_BYTES = _env_parse_int('WEB_FETCH_MAX_BYTES', 5 * 1024 * 1024)
+WEB_FETCH_MAX_REDIRECTS = 5
+# number of processes extracting the text of web pages
+WEB_EXTRACT_WORKERS = _env_parse_int('WEB_EXTRACT_WORKERS', 2)
+# extracted pages are shared across chats, revalidated after the freshness window and dropped after the TTL, in seconds
+URL_CACHE_FRESHNESS = _env_parse_int('URL_CACHE_FRESHNESS', 60 * 60)
+URL_CACHE_TTL = _env_parse_int('URL_CACHE_TTL', 60 * 60 * 24 * 7)
+# max number of pages cached in memory
+URL_CACHE_SIZE = _env_parse_int('URL_CACHE_SIZE', 200)
+# number of threads fetching YouTube transcripts
+YOUTUBE_WORKERS = _env_parse_int('YOUTUBE_WORKERS', 4)
+# videos without transcripts are remembered for a shorter time, in seconds
+YOUTUBE_CACHE_TTL = _env_parse_int('YOUTUBE_CACHE_TTL', 60 * 60 * 24 * 7)
+YOUTUBE_NEGATIVE_CACHE_TTL = _env_parse_int('YOUTUBE_NEGATIVE_CACHE_TTL', 60 * 60 * 6)
+# max number of transcripts cached in memory
+YOUTUBE_CACHE_SIZE = _env_parse_int('YOUTUBE_CACHE_SIZE', 200)
+# link contents are stored once across chats, unused ones are dropped after the TTL in seconds
+CONTEXT_TTL = _env_parse_int('CONTEXT_TTL', 60 * 60 * 24 * 30)
+# summarize ingested links in the background before the summary is requested
+SPECULATIVE_SUMMARY = _env_parse_bool('SPECULATIVE_SUMMARY')
+# in seconds, unused summaries are discarded after it
+SPECULATIVE_SUMMARY_TTL = _env_parse_int('SPECULATIVE_SUMMARY_TTL', 60 * 15)
+SPECULATIVE_SUMMARY_CACHE_SIZE = 500
+# billing of speculative summaries: "used" only when requested, or "always" even if discarded
+SPECULATIVE_SUMMARY_BILLING = os.getenv('SPECULATIVE_SUMMARY_BILLING') or "used"
+# after the summary of a link, follow-ups send the summary and excerpts within this budget in tokens instead of the content,
+# off by default so upgrading doesn't change how follow-ups are answered
+# needs retrieval, without it the excerpts would be the whole content
+CONTEXT_DISTILLATION = _env_parse_bool('CONTEXT_DISTILLATION', False) and RETRIEVAL_ENABLED
+CONTEXT_DISTILLED_BUDGET = _env_parse_int('CONTEXT_DISTILLED_BUDGET', 800)
+# compress the large texts stored in MongoDB, with zstd if installed otherwise zlib
+STORAGE_COMPRESSION = _env_parse_bool('STORAGE_COMPRESSION', True)
+# in characters
+STORAGE_COMPRESSION_MIN_BYTES = _env_parse_int('STORAGE_COMPRESSION_MIN_BYTES', 1024)
+# model routing, balances below the threshold are routed to the cheapest model of the tier
+ROUTER_LOW_BALANCE = _env_parse_int('ROUTER_LOW_BALANCE', 10000)
+# prompts up to this size of the fast chat modes go to the fastest model
+ROUTER_FAST_MAX_TOKENS = _env_parse_int('ROUTER_FAST_MAX_TOKENS', 400)
+# models are avoided when the p95 seconds to the first token or the error rate exceed these
+ROUTER_OVERLOAD_LATENCY = _env_parse_float('ROUTER_OVERLOAD_LATENCY', 10.0)
+ROUTER_MAX_ERROR_RATE = _env_parse_float('ROUTER_MAX_ERROR_RATE', 0.2)
+ROUTER_MIN_SAMPLES = 20
+# cool down in seconds for keys hitting rate limits or auth errors
+KEY_RATE_LIMIT_COOLDOWN = _env_parse_int('KEY_RATE_LIMIT_COOLDOWN', 20)
+KEY_AUTH_COOLDOWN = _env_parse_int('KEY_AUTH_COOLDOWN', 600)
 # getimg.ai
 GETIMG_API_TOKEN = os.getenv('GETIMG_API_TOKEN')
 # sinkin.ai
 SINKIN_ACCOUNT = os.getenv('SINKIN_ACCOUNT')
 # request timeout in seconds
 OPENAI_TIMEOUT = 60
+# pooled HTTP connections shared by all integrations
+HTTP_POOL_SIZE = _env_parse_int('HTTP_POOL_SIZE', 200)
+HTTP_POOL_SIZE_PER_HOST = _env_parse_int('HTTP_POOL_SIZE_PER_HOST', 20)
+OPENAI_POOL_SIZE_PER_HOST = _env_parse_int('OPENAI_POOL_SIZE_PER_HOST', 100)
+# in seconds
+HTTP_TIMEOUT = _env_parse_int('HTTP_TIMEOUT', 300)
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_DNS_CACHE_TTL = 300
+HTTP_KEEPALIVE_TIMEOUT = 30
+# seconds an update may spend waiting on upstream services
+UPDATE_DEADLINE = _env_parse_int('UPDATE_DEADLINE', 300)
+# default timeouts in seconds per integration, chat and fetch are the time to the first token or the response
+UPSTREAM_TIMEOUTS = {
+    "chat": OPENAI_TIMEOUT,
+    "moderation": 15,
+    "whisper": 120,
+    # matches the time a user is locked while generating images
+    "image": IMAGE_TIMEOUT,
+    "tts": 60,
+    "fetch": 30,
+    "youtube": 30,
+    "api": 15,
+}
 # whisper api has 25MB of file size limit, set 20MB to maintain buffer
 WHISPER_FILE_SIZE_LIMIT = 20 * 1000 * 1000
 # in seconds
@@ -168,6 +278,15 @@ COQUI_TOKENS = 200
 # duration per character in second
 TTS_ESTIMATED_DURATION_BASE = 0.05
 STREAM_ENABLED = True
+# Telegram flood limits, messages per second across all chats
+TELEGRAM_GLOBAL_RATE = _env_parse_int('TELEGRAM_GLOBAL_RATE', 30)
+# messages per second in a private chat
+TELEGRAM_PRIVATE_CHAT_RATE = 1
+# messages per minute in a group chat
+TELEGRAM_GROUP_CHAT_RATE = 20
+# min and max seconds between edits of a streaming answer, adapted to the current load
+STREAM_EDIT_INTERVAL = _env_parse_float('STREAM_EDIT_INTERVAL', 1.0)
+STREAM_EDIT_MAX_INTERVAL = 5
 ALLOWED_TELEGRAM_USERNAMES = _env_parse_str_array('ALLOWED_TELEGRAM_USERNAMES')
 DEFAULT_CHAT_MODE = list(DEFAULT_CHAT_MODES.keys())[0]
 DEFAULT_MODEL = list(DEFAULT_MODELS.keys())[0]
@@ -175,4 +294,25 @@ DEFAULT_CHAT_TIMEOUT = _env_parse_int('DEFAULT_CHAT_TIMEOUT', 60 * 60 * 1)
 API_ENDPOINT = os.getenv('API_ENDPOINT')
 WEB_APP_URL = os.getenv('WEB_APP_URL')
 BUGREPORT_BOT_TOKEN = os.getenv('BUGREPORT_BOT_TOKEN')
-BUGREPORT_CHAT_ID = os.getenv('BUGREPORT_CHAT_ID')
\ No newline at end of file
+BUGREPORT_CHAT_ID = os.getenv('BUGREPORT_CHAT_ID')
+# max number of answers generated at the same time across all chats
+MAX_CONCURRENT_GENERATIONS = _env_parse_int('MAX_CONCURRENT_GENERATIONS', 32)
+# cache answers of the chat modes without history
+ANSWER_CACHE_ENABLED = _env_parse_bool('ANSWER_CACHE_ENABLED', True)
+# max number of answers cached in memory, all of them are also shared through MongoDB
+ANSWER_CACHE_SIZE = _env_parse_int('ANSWER_CACHE_SIZE', 2000)
+# in seconds
+ANSWER_CACHE_TTL = _env_parse_int('ANSWER_CACHE_TTL', 60 * 60 * 24 * 7)
+# billing of cached answers: "full" as if generated, "completion" for completion tokens only, or "free"
+ANSWER_CACHE_BILLING = os.getenv('ANSWER_CACHE_BILLING') or "full"
+# interval in seconds to print in-process metrics
+METRICS_REPORT_INTERVAL = _env_parse_int('METRICS_REPORT_INTERVAL', 300)
+# hedged chat requests, send a second request to the alternate backend if the first token is late
+HEDGE_ENABLED = _env_parse_bool('HEDGE_ENABLED')
+# percentile of recent first token latencies used as the hedging deadline
+HEDGE_PERCENTILE = _env_parse_int('HEDGE_PERCENTILE', 95)
+# bounds of the hedging deadline in seconds
+HEDGE_MIN_DELAY = _env_parse_float('HEDGE_MIN_DELAY', 2.0)
+HEDGE_MAX_DELAY = _env_parse_float('HEDGE_MAX_DELAY', 8.0)
+# use HEDGE_MAX_DELAY until enough latencies are collected
+HEDGE_MIN_SAMPLES = 20
\ No newline at end of file
@@ -1,10 +1,12 @@
-from datetime import datetime
+import hashlib
+from datetime import datetime, timedelta
 from typing import Any
 
 import pymongo
 from bson import ObjectId
 
 import config
+import codec
 
 
 class Database:
@@ -17,6 +19,16 @@ class Database:
         self.role_collection = self.db["roles"]
         self.message_collection = self.db["chat_messages"]
         self.stat_collection = self.db["stats"]
+        self.answer_cache_collection = self.db["answer_cache"]
+        self.url_cache_collection = self.db["url_cache"]
+        # link contents keyed by their hash, shared by the chats referring to them
+        self.context_collection = self.db["contexts"]
+
+    def ensure_indexes(self):
+        # expire cached documents at `expire_at`
+        self.answer_cache_collection.create_index("expire_at", expireAfterSeconds=0)
+        self.url_cache_collection.create_index("expire_at", expireAfterSeconds=0)
+        self.context_collection.create_index("expire_at", expireAfterSeconds=0)
 
     def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
         if self.user_collection.count_documents({"_id": user_id}) > 0:
@@ -70,7 +82,10 @@ class Database:
 
         if clear_messages:
             data["messages"] = []
+            data["summary"] = None
             data["context"] = None
+            data["context_ref"] = None
+            data["context_summary"] = None
             data["context_src"] = None
         else:
             default_data["messages"] = []
@@ -87,7 +102,8 @@ class Database:
         return self.get_chat_attributes(chat_id, [key])[0]
     
     def get_chat_attributes(self, chat_id: int, keys: list):
-        doc = self.chat_collection.find_one({"_id": chat_id})
+        # only load the requested fields, the messages and the context can be large
+        doc = self.chat_collection.find_one({"_id": chat_id}, {key: 1 for key in keys})
 
         ret = []
         for key in keys:
@@ -127,13 +143,52 @@ class Database:
 
     def set_chat_context(self, chat_id: int, context: str, context_src: str):
         self.set_chat_attributes(chat_id, {
-            'context': context,
+            'context': None,
+            'context_ref': self.store_context(context),
             'context_src': context_src,
+            'context_summary': None,
             'messages': [],
+            'summary': None,
         })
 
+    def set_chat_context_summary(self, chat_id: int, context_summary: str, context_mode: str):
+        self.set_chat_attributes(chat_id, {
+            'context_summary': context_summary,
+            'context_mode': context_mode,
+        })
+
+    def get_chat_context_summary(self, chat_id: int):
+        """Returns the summary of the context and whether follow-ups use it ("distilled") or the full text ("full")."""
+        return self.get_chat_attributes(chat_id, ['context_summary', 'context_mode'])
+
     def get_chat_context(self, chat_id: int):
-        return self.get_chat_attributes(chat_id, ['context', 'context_src'])
+        context, context_ref, context_src = self.get_chat_attributes(chat_id, ['context', 'context_ref', 'context_src'])
+        if context_ref is not None:
+            context = self.load_context(context_ref)
+            if context is None:
+                # expired
+                context_src = None
+        # chats saved before the contexts collection keep their own copy in `context`
+        return context, context_src
+
+    def store_context(self, context: str):
+        """Stores the content once for all the chats, returns its reference."""
+        ref = hashlib.sha256(context.encode()).hexdigest()
+        self.context_collection.update_one({"_id": ref}, {
+            "$set": {"expire_at": datetime.now() + timedelta(seconds=config.CONTEXT_TTL)},
+            "$setOnInsert": {"data": codec.encode(context), "size": len(context), "created_at": datetime.now()},
+        }, upsert=True)
+        return ref
+
+    def load_context(self, ref: str):
+        doc = self.context_collection.find_one({"_id": ref})
+        if doc is None:
+            return None
+        context = codec.decode(doc["data"])
+        if (doc["expire_at"] - datetime.now()).total_seconds() < config.CONTEXT_TTL / 2:
+            # keep the contents in use, refreshed at most once per half TTL
+            self.context_collection.update_one({"_id": ref}, {"$set": {"expire_at": datetime.now() + timedelta(seconds=config.CONTEXT_TTL)}})
+        return context
 
     def get_current_model(self, chat_id: int):
         return self.get_chat_attribute(chat_id, 'current_model') or config.DEFAULT_MODEL
@@ -156,7 +211,22 @@ class Database:
         return self.get_chat_attribute(chat_id, 'last_interaction')
     
     def get_chat_messages(self, chat_id: int):
-        return self.get_chat_attribute(chat_id, 'messages')
+        return codec.decode_messages(self.get_chat_attribute(chat_id, 'messages'))
+
+    def get_chat_messages_and_summary(self, chat_id: int):
+        messages, summary = self.get_chat_attributes(chat_id, ['messages', 'summary'])
+        return codec.decode_messages(messages), summary
+
+    def fold_chat_messages(self, chat_id: int, summary: str, new_summary: str, dates: list):
+        """Replaces the messages at `dates` by the new summary, returns False if the chat has changed since reading `summary`."""
+        result = self.chat_collection.update_one(
+            {"_id": chat_id, "summary": summary, "messages.date": {"$all": dates}},
+            {
+                "$set": {"summary": new_summary},
+                "$pull": {"messages": {"date": {"$in": dates}}},
+            }
+        )
+        return result.modified_count > 0
 
     def pop_chat_messages(self, chat_id: int):
         filter = {"_id": chat_id}
@@ -184,6 +254,8 @@ class Database:
         data = {
             "last_interaction": datetime.now()
         }
+        # long turns, e.g. summaries of links, are stored compressed
+        new_dialog_message = codec.encode_message(new_dialog_message)
         if max_message_count > 0:
             self.chat_collection.update_one(
                 filter,
@@ -258,7 +330,7 @@ class Database:
     def cache_chat_message(self, message):
         data = {
             '_id': ObjectId(),
-            'message': message,
+            'message': codec.encode(message),
             "date": datetime.now(),
         }
 
@@ -268,7 +340,33 @@ class Database:
     
     def get_cached_message(self, id):
         doc = self.message_collection.find_one({ '_id': ObjectId(id) })
-        return doc["message"] if doc else None
+        return codec.decode(doc["message"]) if doc else None
+    
+    def get_cached_answer(self, key: str):
+        doc = self.answer_cache_collection.find_one({"_id": key})
+        # the TTL monitor runs every 60 seconds
+        if doc is None or doc["expire_at"] < datetime.now():
+            return None
+        return doc
+
+    def set_cached_answer(self, key: str, answer: str, num_completion_tokens: int, expire_at: datetime):
+        data = {
+            "answer": answer,
+            "num_completion_tokens": num_completion_tokens,
+            "expire_at": expire_at,
+        }
+        self.answer_cache_collection.update_one({"_id": key}, {"$set": data}, upsert=True)
+
+    def get_cached_url(self, key: str):
+        doc = self.url_cache_collection.find_one({"_id": key})
+        if doc is None or doc["expire_at"] < datetime.now():
+            return None
+        return doc
+
+    def set_cached_url(self, key: str, entry: dict, expire_at: datetime):
+        data = {k: v for k, v in entry.items() if k != "_id"}
+        data["expire_at"] = expire_at
+        self.url_cache_collection.update_one({"_id": key}, {"$set": data}, upsert=True)
     
     def get_custom_roles(self, user_id: int):
         filter = {
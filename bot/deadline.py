@@ -0,0 +1,81 @@
+import time
+import asyncio
+import functools
+import contextvars
+
+import config
+import metrics
+
+# every update gets a deadline, upstream calls are bounded by their own timeout and the time left
+
+class Deadline:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self):
+        return max(0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+class UpstreamTimeout(asyncio.TimeoutError):
+    def __init__(self, operation: str, timeout: float):
+        super().__init__(f"{operation} request timed out after {timeout:.0f}s")
+        self.operation = operation
+        self.timeout = timeout
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+def current() -> Deadline:
+    return _current.get()
+
+def timeout(operation: str) -> float:
+    """Seconds the operation may take, its default timeout capped by the deadline of the current update."""
+    seconds = config.UPSTREAM_TIMEOUTS[operation]
+    deadline = current()
+    if deadline is not None:
+        seconds = min(seconds, deadline.remaining())
+    return seconds
+
+class _InnerTimeout(Exception):
+    # carries a timeout raised by the call itself past wait_for
+    def __init__(self, error: asyncio.TimeoutError):
+        super().__init__()
+        self.error = error
+
+async def _tag_inner_timeout(awaitable):
+    try:
+        return await awaitable
+    except asyncio.TimeoutError as e:
+        raise _InnerTimeout(e)
+
+async def run(operation: str, awaitable):
+    """Awaits the upstream call, cancels it and raises UpstreamTimeout once it takes too long.
+
+    Timeouts raised by the call itself, e.g. socket timeouts of the session, are re-raised unchanged.
+    """
+    seconds = timeout(operation)
+    try:
+        return await asyncio.wait_for(_tag_inner_timeout(awaitable), seconds)
+    except _InnerTimeout as e:
+        raise e.error
+    except asyncio.TimeoutError:
+        metrics.inc(f"timeouts.{operation}")
+        print(f"{operation} request timed out after {seconds:.1f}s")
+        raise UpstreamTimeout(operation, seconds)
+
+def start(seconds: float = None):
+    """Starts a new deadline in the current context, returns the token to reset it."""
+    return _current.set(Deadline(seconds or config.UPDATE_DEADLINE))
+
+def scoped(handler, seconds: float = None):
+    """Wraps a handler to run with a new deadline."""
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        token = start(seconds)
+        try:
+            return await handler(update, context, *args, **kwargs)
+        finally:
+            _current.reset(token)
+    return wrapper
@@ -0,0 +1,84 @@
+import time
+import asyncio
+import functools
+import contextlib
+
+import config
+import metrics
+import generations
+import deadline
+
+class ChatDispatcher:
+    """Runs updates of the same chat in order, different chats in parallel, with a global concurrency cap."""
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._locks = {}
+        # number of updates queued or running per chat
+        self._refs = {}
+        self.queued = 0
+        self.running = 0
+
+    def _get_semaphore(self):
+        # create lazily to bind the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _report(self):
+        metrics.set_gauge("dispatcher.queued", self.queued)
+        metrics.set_gauge("dispatcher.running", self.running)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id: int):
+        start_time = time.monotonic()
+        if chat_id not in self._locks:
+            self._locks[chat_id] = asyncio.Lock()
+            self._refs[chat_id] = 0
+        lock = self._locks[chat_id]
+        self._refs[chat_id] += 1
+        self.queued += 1
+        waiting = True
+        self._report()
+        try:
+            async with lock:
+                async with self._get_semaphore():
+                    waiting = False
+                    self.queued -= 1
+                    self.running += 1
+                    self._report()
+                    metrics.observe("dispatcher.wait", time.monotonic() - start_time)
+                    try:
+                        yield
+                    finally:
+                        self.running -= 1
+                        self._report()
+        finally:
+            if waiting:
+                self.queued -= 1
+                self._report()
+            self._refs[chat_id] -= 1
+            if self._refs[chat_id] == 0:
+                del self._refs[chat_id]
+                del self._locks[chat_id]
+
+dispatcher = ChatDispatcher(config.MAX_CONCURRENT_GENERATIONS)
+
+def serialized(handler, preempt=None):
+    """Wraps a handler to run through the chat dispatcher with a deadline starting once it runs.
+
+    `preempt(update)` decides if the update cancels the in-flight generation of the chat instead of waiting for it.
+    """
+    handler = deadline.scoped(handler)
+
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        chat = update.effective_chat
+        if chat is None:
+            return await handler(update, context, *args, **kwargs)
+        if preempt is not None and preempt(update):
+            await generations.cancel(chat.id)
+        async with dispatcher.slot(chat.id):
+            return await handler(update, context, *args, **kwargs)
+    return wrapper
@@ -1,4 +1,5 @@
 import config
+import deadline
 import openai_utils
 import replicate_utils
 import sinkinai_utils
@@ -45,6 +46,9 @@ def _build_image_data(image_urls):
     return [{"image": url} for url in image_urls]
 
 async def inference(model, prompt, width, height):
+    return await deadline.run("image", _inference(model, prompt, width, height))
+
+async def _inference(model, prompt, width, height):
     result = None
     if model == "dalle":
         images = await openai_utils.create_image(prompt)
@@ -63,7 +67,7 @@ async def inference(model, prompt, width, height):
     return result
 
 async def upscale(image, scale: float = 2):
-    image = await getimg_utils.upscale(image)
+    image = await deadline.run("image", getimg_utils.upscale(image))
     if image is None:
         raise Exception("failed to upscale")
     return image
@@ -0,0 +1,31 @@
+import asyncio
+
+import metrics
+
+# max seconds to wait for a cancelled generation to settle its billing
+CANCEL_TIMEOUT = 5
+
+# in-flight generation task of each chat
+_tasks = {}
+
+def register(chat_id: int, task: asyncio.Task):
+    _tasks[chat_id] = task
+
+def unregister(chat_id: int, task: asyncio.Task):
+    if _tasks.get(chat_id) is task:
+        del _tasks[chat_id]
+
+def is_generating(chat_id: int):
+    task = _tasks.get(chat_id)
+    return task is not None and not task.done()
+
+async def cancel(chat_id: int):
+    """Cancels the in-flight generation of the chat, returns True if there was one."""
+    task = _tasks.pop(chat_id, None)
+    if task is None or task.done() or task is asyncio.current_task():
+        return False
+    task.cancel()
+    metrics.inc("generations.cancelled")
+    # let the generation close the upstream stream before the caller moves on
+    await asyncio.wait({task}, timeout=CANCEL_TIMEOUT)
+    return True
@@ -1,22 +1,18 @@
 import re
-import aiohttp
 import functools
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 from database import Database
 import config
+import http_client
 from telegram import PhotoSize
 from typing import Tuple
 
 async def http_post(url, data, result_type="json", headers=None):
-    session_args = {}
-    if headers is not None:
-        session_args["headers"] = headers
-    async with aiohttp.ClientSession(**session_args) as session:
-        async with session.post(url, data=data) as response:
-            if result_type == "json":
-                return await response.json()
-            else:
-                return await response.text()
+    async with http_client.get().post(url, data=data, headers=headers) as response:
+        if result_type == "json":
+            return await response.json()
+        else:
+            return await response.text()
 
 def is_uri(s):
     try:
@@ -25,6 +21,19 @@ def is_uri(s):
     except:
         return False
 
+# query parameters which don't change the content of a page
+TRACKING_PARAMS = set(["fbclid", "gclid", "igshid", "mc_cid", "mc_eid", "ref", "ref_src", "spm"])
+
+def normalize_url(url: str):
+    """Canonical form of the URL to share the content of the same page."""
+    result = urlparse(url.strip())
+    scheme = result.scheme.lower()
+    netloc = result.netloc.lower()
+    if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    query = [(k, v) for k, v in parse_qsl(result.query, keep_blank_values=True) if not k.startswith("utm_") and k not in TRACKING_PARAMS]
+    return urlunparse((scheme, netloc, result.path or "/", result.params, urlencode(sorted(query)), ""))
+
 def is_youtube_url(url: str):
     domain = urlparse(url).netloc
     return domain.endswith("youtube.com") or domain.endswith("youtu.be")
@@ -0,0 +1,49 @@
+import aiohttp
+
+import config
+
+# application scoped HTTP sessions, connections are pooled and kept alive across requests
+
+PROFILES = {
+    "default": {
+        "limit_per_host": config.HTTP_POOL_SIZE_PER_HOST,
+        # image inference may take minutes
+        "timeout": aiohttp.ClientTimeout(total=config.HTTP_TIMEOUT, sock_connect=config.HTTP_CONNECT_TIMEOUT),
+    },
+    "openai": {
+        # streams have no total timeout, only gaps between chunks are limited
+        "limit_per_host": config.OPENAI_POOL_SIZE_PER_HOST,
+        "timeout": aiohttp.ClientTimeout(total=None, sock_connect=config.HTTP_CONNECT_TIMEOUT, sock_read=config.OPENAI_TIMEOUT),
+    },
+}
+
+_sessions = {}
+
+def _create_session(name: str) -> aiohttp.ClientSession:
+    profile = PROFILES[name]
+    connector = aiohttp.TCPConnector(
+        limit=config.HTTP_POOL_SIZE,
+        limit_per_host=profile["limit_per_host"],
+        ttl_dns_cache=config.HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=profile["timeout"])
+
+def get(name: str = "default") -> aiohttp.ClientSession:
+    """Returns the session of the profile, creates it if the application hasn't started it yet."""
+    session = _sessions.get(name)
+    if session is None or session.closed:
+        session = _create_session(name)
+        _sessions[name] = session
+    return session
+
+async def start():
+    for name in PROFILES:
+        get(name)
+
+async def close():
+    sessions = list(_sessions.values())
+    _sessions.clear()
+    for session in sessions:
+        if not session.closed:
+            await session.close()
@@ -0,0 +1,149 @@
+import time
+import collections
+
+import openai
+
+import config
+import metrics
+
+# quota windows are per minute
+WINDOW = 60
+
+class ConfigurationError(Exception):
+    pass
+
+class Credential:
+    def __init__(self, api_type: str, api_key: str, api_base: str = None, api_version: str = None, rpm: int = None, tpm: int = None):
+        self.api_type = api_type
+        self.api_key = api_key
+        self.api_base = api_base
+        self.api_version = api_version
+        self.rpm = rpm or config.OPENAI_KEY_RPM
+        self.tpm = tpm or config.OPENAI_KEY_TPM
+        self.requests = collections.deque()
+        self.tokens = collections.deque()
+        self.num_tokens = 0
+        self.cooldown_until = 0
+
+    @property
+    def name(self):
+        # never print the full key
+        return f"{self.api_type}:...{self.api_key[-4:]}"
+
+    def _expire(self, now):
+        while self.requests and now - self.requests[0] > WINDOW:
+            self.requests.popleft()
+        while self.tokens and now - self.tokens[0][0] > WINDOW:
+            _, num_tokens = self.tokens.popleft()
+            self.num_tokens -= num_tokens
+
+    def headroom(self, now=None):
+        now = now or time.monotonic()
+        self._expire(now)
+        return min(1 - len(self.requests) / self.rpm, 1 - self.num_tokens / self.tpm)
+
+    def is_cooling_down(self, now=None):
+        return (now or time.monotonic()) < self.cooldown_until
+
+    def record(self, num_tokens: int, request: bool = True):
+        now = time.monotonic()
+        if request:
+            self.requests.append(now)
+        self.tokens.append((now, num_tokens))
+        self.num_tokens += num_tokens
+
+    def refund(self, num_tokens: int):
+        # takes back the tokens of a request whose stream was dropped
+        for i in range(len(self.tokens) - 1, -1, -1):
+            if self.tokens[i][1] == num_tokens:
+                del self.tokens[i]
+                self.num_tokens -= num_tokens
+                return
+
+    def cool_down(self, seconds: float):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def request_args(self):
+        args = {
+            "api_type": self.api_type,
+            "api_key": self.api_key,
+        }
+        if self.api_base:
+            args["api_base"] = self.api_base
+        if self.api_version:
+            args["api_version"] = self.api_version
+        return args
+
+class KeyPool:
+    def __init__(self, api_type: str, credentials: list):
+        self.api_type = api_type
+        self.credentials = credentials
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def acquire(self, num_tokens: int = 0, exclude: Credential = None) -> Credential:
+        """Picks the credential with the most remaining headroom and records the usage.
+
+        Returns None only when `exclude` was the last credential left.
+        """
+        if not self.credentials:
+            env = "AZURE_OPENAI_API_KEY" if self.api_type == "azure" else "OPENAI_API_KEY"
+            raise ConfigurationError(f"no {self.api_type} API key configured, set {env}")
+        now = time.monotonic()
+        candidates = [c for c in self.credentials if c is not exclude]
+        if not candidates:
+            return None
+        available = [c for c in candidates if not c.is_cooling_down(now)]
+        if available:
+            credential = max(available, key=lambda c: c.headroom(now))
+        else:
+            # all keys are cooling down, use the one that recovers first
+            credential = min(candidates, key=lambda c: c.cooldown_until)
+        credential.record(num_tokens)
+        return credential
+
+    def report_error(self, credential: Credential, e: Exception):
+        if isinstance(e, openai.error.RateLimitError):
+            seconds = config.KEY_RATE_LIMIT_COOLDOWN
+            metrics.inc("key_pool.rate_limited")
+        elif isinstance(e, (openai.error.AuthenticationError, openai.error.PermissionError)):
+            seconds = config.KEY_AUTH_COOLDOWN
+            metrics.inc("key_pool.auth_errors")
+        else:
+            return
+        print(f"cool down {credential.name} for {seconds}s: {type(e).__name__}")
+        credential.cool_down(seconds)
+
+def _build_pools():
+    openai_keys = [config.OPENAI_API_KEY] + [key for key in config.OPENAI_API_KEYS if key != config.OPENAI_API_KEY]
+    pools = {
+        config.DEFAULT_OPENAI_API_TYPE: KeyPool(config.DEFAULT_OPENAI_API_TYPE, [Credential(config.DEFAULT_OPENAI_API_TYPE, key) for key in openai_keys if key]),
+    }
+
+    azure_credentials = []
+    if config.AZURE_OPENAI_API_KEY:
+        azure_credentials.append(Credential("azure", config.AZURE_OPENAI_API_KEY, config.AZURE_OPENAI_API_BASE, config.AZURE_OPENAI_API_VERSION))
+    for entry in config.AZURE_OPENAI_API_KEYS:
+        # each entry is either `key` or `api_base|key` for keys of other Azure resources
+        api_base, key = entry.split("|", 1) if "|" in entry else (config.AZURE_OPENAI_API_BASE, entry)
+        if key and key != config.AZURE_OPENAI_API_KEY:
+            azure_credentials.append(Credential("azure", key, api_base, config.AZURE_OPENAI_API_VERSION))
+    pools["azure"] = KeyPool("azure", azure_credentials)
+    return pools
+
+_pools = None
+
+def get_pool(api_type: str = None) -> KeyPool:
+    global _pools
+    if _pools is None:
+        _pools = _build_pools()
+    if api_type != "azure":
+        api_type = config.DEFAULT_OPENAI_API_TYPE
+    return _pools[api_type]
+
+def acquire(api_type: str = None, num_tokens: int = 0, exclude: Credential = None) -> Credential:
+    return get_pool(api_type).acquire(num_tokens, exclude=exclude)
+
+def report_error(credential: Credential, e: Exception):
+    get_pool(credential.api_type).report_error(credential, e)
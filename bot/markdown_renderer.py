@@ -0,0 +1,231 @@
+import re
+import html
+
+import config
+
+# converts the Markdown of model answers to Telegram HTML, the output is always parseable
+
+FENCE_PATTERN = re.compile(r"^\s*(```|~~~)\s*([\w#+.-]*)\s*$")
+HEADING_PATTERN = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+BULLET_PATTERN = re.compile(r"^(\s*)[-*+]\s+(.*)$")
+LINK_PATTERN = re.compile(r"\[([^\]\n]+)\]\(((?:https?|tg|mailto):[^)\s]+)\)")
+CODE_SPAN_PATTERN = re.compile(r"(`+)([^`\n]|[^`\n].*?[^`\n])\1")
+
+# markers in the order they are matched
+INLINE_MARKERS = [
+    ("**", "b"),
+    ("__", "b"),
+    ("~~", "s"),
+    ("*", "i"),
+    ("_", "i"),
+]
+
+SEPARATOR = "\n\n"
+
+class Block:
+    def __init__(self, kind: str, lines: list, lang: str = None, fence: str = None):
+        # kind is either "text" or "code"
+        self.kind = kind
+        self.lines = lines
+        self.lang = lang
+        # ``` or ~~~ of a code block, only the same fence closes it
+        self.fence = fence
+
+    @property
+    def source(self):
+        return "\n".join(self.lines)
+
+def parse_blocks(text: str):
+    """Splits Markdown into paragraphs and code blocks, an unclosed code fence runs to the end."""
+    blocks = []
+    current = None
+    for line in text.split("\n"):
+        if current is not None and current.kind == "code":
+            m = FENCE_PATTERN.match(line)
+            if m and not m.group(2) and m.group(1) == current.fence:
+                current = None
+            else:
+                current.lines.append(line)
+            continue
+        m = FENCE_PATTERN.match(line)
+        if m:
+            current = Block("code", [], lang=m.group(2) or None, fence=m.group(1))
+            blocks.append(current)
+        elif not line.strip():
+            current = None
+        else:
+            if current is None:
+                current = Block("text", [])
+                blocks.append(current)
+            current.lines.append(line)
+    return blocks
+
+IDENTIFIER_PATTERN = re.compile(r"\w+")
+
+def _can_open(text, i, marker):
+    end = i + len(marker)
+    if end >= len(text) or text[end].isspace():
+        return False
+    if text[end] == marker[0] or (len(marker) == 1 and i > 0 and text[i - 1] == marker):
+        # part of a longer run, e.g. a stray ** isn't an empty italic
+        return False
+    if marker[0] == "_" and i > 0 and text[i - 1].isalnum():
+        # ignore snake_case
+        return False
+    return True
+
+def _can_close(text, i, marker, start):
+    if i == start or text[i - 1].isspace():
+        # no empty emphasis
+        return False
+    end = i + len(marker)
+    if marker[0] == "_" and end < len(text) and text[end].isalnum():
+        return False
+    if marker == "__" and IDENTIFIER_PATTERN.fullmatch(text[start:i]):
+        # dunder names like __init__
+        return False
+    return True
+
+def _render_emphasis(text: str):
+    out = []
+    # open markers with the index of their placeholder in out and where their content starts in text
+    stack = []
+    i = 0
+    while i < len(text):
+        for marker, tag in INLINE_MARKERS:
+            if not text.startswith(marker, i):
+                continue
+            if stack and stack[-1][0] == marker and _can_close(text, i, marker, stack[-1][2]):
+                _, index, _ = stack.pop()
+                out[index] = f"<{tag}>"
+                out.append(f"</{tag}>")
+                i += len(marker)
+                break
+            if all(m != marker for m, _, _ in stack) and _can_open(text, i, marker):
+                stack.append((marker, len(out), i + len(marker)))
+                out.append(html.escape(marker))
+                i += len(marker)
+                break
+        else:
+            out.append(html.escape(text[i]))
+            i += 1
+            continue
+    # unclosed markers stay as plain text
+    return "".join(out)
+
+def _render_links(text: str):
+    out = []
+    start = 0
+    for m in LINK_PATTERN.finditer(text):
+        out.append(_render_emphasis(text[start:m.start()]))
+        out.append('<a href="{}">{}</a>'.format(html.escape(m.group(2), quote=True), _render_emphasis(m.group(1))))
+        start = m.end()
+    out.append(_render_emphasis(text[start:]))
+    return "".join(out)
+
+def render_inline(text: str):
+    out = []
+    start = 0
+    for m in CODE_SPAN_PATTERN.finditer(text):
+        out.append(_render_links(text[start:m.start()]))
+        out.append("<code>{}</code>".format(html.escape(m.group(2).strip())))
+        start = m.end()
+    out.append(_render_links(text[start:]))
+    return "".join(out)
+
+def render_line(line: str):
+    m = HEADING_PATTERN.match(line)
+    if m:
+        # headings are bold as a whole, bold inside would nest
+        return "<b>{}</b>".format(render_inline(m.group(1)).replace("<b>", "").replace("</b>", ""))
+    m = BULLET_PATTERN.match(line)
+    if m:
+        return "{}• {}".format(m.group(1), render_inline(m.group(2)))
+    return render_inline(line)
+
+def render_block(block: Block):
+    if block.kind == "code":
+        code = html.escape(block.source)
+        if block.lang:
+            return '<pre><code class="language-{}">{}</code></pre>'.format(html.escape(block.lang, quote=True), code)
+        return "<pre>{}</pre>".format(code)
+    return "\n".join(render_line(line) for line in block.lines)
+
+def _rendered_line_length(block: Block, line: str):
+    return len(html.escape(line)) if block.kind == "code" else len(render_line(line))
+
+def _split_line(block: Block, line: str, max_line_length: int):
+    """Cuts the longest prefixes of the line which fit after rendering."""
+    pieces = []
+    while _rendered_line_length(block, line) > max_line_length:
+        low, high = 1, len(line) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if _rendered_line_length(block, line[:middle]) <= max_line_length:
+                low = middle
+            else:
+                high = middle - 1
+        pieces.append(line[:low])
+        line = line[low:]
+    pieces.append(line)
+    return pieces
+
+def _split_block(block: Block, max_length: int):
+    """Greedily packs the lines of an oversized block into blocks which fit, the earlier parts stay stable while the block grows."""
+    overhead = len(render_block(Block(block.kind, [""], lang=block.lang)))
+    max_line_length = max_length - overhead
+    parts = []
+    lines = []
+    length = overhead
+    for line in block.lines:
+        for piece in _split_line(block, line, max_line_length):
+            piece_length = _rendered_line_length(block, piece)
+            if lines and length + 1 + piece_length > max_length:
+                parts.append(lines)
+                lines, length = [], overhead
+            length += piece_length + (1 if lines else 0)
+            lines.append(piece)
+    if lines:
+        parts.append(lines)
+    return [Block(block.kind, part, lang=block.lang) for part in parts]
+
+class Renderer:
+    """Renders growing answers, caches blocks which are already complete."""
+
+    def __init__(self, max_length: int = config.MESSAGE_MAX_LENGTH):
+        self.max_length = max_length
+        self.cache = {}
+
+    def _render(self, block: Block, cache: dict):
+        key = (block.kind, block.lang, block.source)
+        self.cache[key] = cache[key] if key in cache else render_block(block)
+        return self.cache[key]
+
+    def render(self, text: str):
+        """Returns the HTML chunks of the text, each fits in a single message."""
+        # only keep the blocks of the latest text
+        cache, self.cache = self.cache, {}
+        rendered = []
+        for block in parse_blocks(text):
+            html_block = self._render(block, cache)
+            if len(html_block) > self.max_length:
+                rendered.extend(self._render(part, cache) for part in _split_block(block, self.max_length))
+            else:
+                rendered.append(html_block)
+
+        chunks = []
+        current = ""
+        for html_block in rendered:
+            if current and len(current) + len(SEPARATOR) + len(html_block) > self.max_length:
+                chunks.append(current)
+                current = html_block
+            elif current:
+                current += SEPARATOR + html_block
+            else:
+                current = html_block
+        if current or not chunks:
+            chunks.append(current)
+        return chunks
+
+def render(text: str, max_length: int = config.MESSAGE_MAX_LENGTH):
+    return Renderer(max_length).render(text)
@@ -0,0 +1,106 @@
+import time
+import asyncio
+import collections
+
+import config
+
+# in-process counters, gauges and latency windows, reported periodically
+
+WINDOW_SIZE = 500
+
+_counters = collections.defaultdict(int)
+_gauges = {}
+_windows = {}
+
+class LatencyWindow:
+    """Rolling window of recent samples (in seconds) to query percentiles."""
+
+    def __init__(self, size: int = WINDOW_SIZE):
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, value: float):
+        self.samples.append(value)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def mean(self, default: float = None):
+        if not self.samples:
+            return default
+        return sum(self.samples) / len(self.samples)
+
+    def percentile(self, p: float, default: float = None):
+        if not self.samples:
+            return default
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+        return ordered[index]
+
+def inc(name: str, amount: int = 1):
+    _counters[name] += amount
+
+def get(name: str):
+    return _counters[name] if name in _counters else 0
+
+def set_gauge(name: str, value):
+    _gauges[name] = value
+
+def window(name: str) -> LatencyWindow:
+    if name not in _windows:
+        _windows[name] = LatencyWindow()
+    return _windows[name]
+
+def observe(name: str, value: float):
+    window(name).add(value)
+
+def ratio(numerator: str, denominator: str):
+    total = get(denominator)
+    return get(numerator) / total if total > 0 else 0
+
+class timer:
+    """Context manager observing the elapsed time of a block under `name`."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.monotonic() - self.start)
+
+def snapshot():
+    data = {
+        "counters": dict(_counters),
+        "gauges": dict(_gauges),
+        "latency": {},
+    }
+    for name, w in _windows.items():
+        if len(w) == 0:
+            continue
+        data["latency"][name] = {
+            "count": len(w),
+            "p50": w.percentile(50),
+            "p90": w.percentile(90),
+            "p99": w.percentile(99),
+        }
+    return data
+
+def report():
+    data = snapshot()
+    lines = ["[metrics]"]
+    for name, value in sorted(data["counters"].items()):
+        lines.append(f"  {name}={value}")
+    for name, value in sorted(data["gauges"].items()):
+        lines.append(f"  {name}={value}")
+    for name, value in sorted(data["latency"].items()):
+        lines.append("  {} count={} p50={:.3f}s p90={:.3f}s p99={:.3f}s".format(name, value["count"], value["p50"], value["p90"], value["p99"]))
+    print("\n".join(lines))
+
+async def report_periodically(interval: int = None):
+    interval = interval or config.METRICS_REPORT_INTERVAL
+    while True:
+        await asyncio.sleep(interval)
+        report()
@@ -1,14 +1,19 @@
 import tiktoken
 import openai
 import config
+import key_pool
+import http_client
+import deadline
 
 MODEL_GPT_35_TURBO = "gpt-3.5-turbo-1106"
 MODEL_GPT_4 = "gpt-4"
+MODEL_GPT_4_TURBO = "gpt-4-1106-preview"
 # MODEL_GPT_4_32K = "gpt-4-32k"
 
 SUPPORTED_MODELS = set([
     MODEL_GPT_35_TURBO,
     MODEL_GPT_4,
+    MODEL_GPT_4_TURBO,
     # MODEL_GPT_4_32K,
 ])
 
@@ -26,8 +31,8 @@ def num_tokens_from_string(string: str, model: str) -> int:
     return num_tokens
 
 def max_output_tokens(model: str, num_context_tokens: int = None):
-    if model == MODEL_GPT_35_TURBO:
-        return 4096
+    if model in (MODEL_GPT_35_TURBO, MODEL_GPT_4_TURBO):
+        return min(4096, max_context_tokens(model) - (num_context_tokens or 0))
     else:
         return max_context_tokens(model) - num_context_tokens
 
@@ -36,6 +41,8 @@ def max_context_tokens(model):
         return 16384
     elif model == MODEL_GPT_4:
         return 8192
+    elif model == MODEL_GPT_4_TURBO:
+        return 128000
     # elif model == MODEL_GPT_4_32K:
     #     return 32768
     else:
@@ -84,7 +91,7 @@ def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
-def chatgpt_prompt(system_prompt, chat_messages, new_message):
+def chatgpt_prompt(system_prompt, chat_messages, new_message, summary=None):
     messages = [
         {
             "role": "system",
@@ -92,6 +99,13 @@ def chatgpt_prompt(system_prompt, chat_messages, new_message):
         }
     ]
 
+    # earlier turns folded into a summary
+    if summary:
+        messages.append({
+            "role": "system",
+            "content": "Summary of the earlier conversation:\n" + summary,
+        })
+
     # add chat context
     if len(chat_messages) > 0:
         for message in chat_messages:
@@ -112,9 +126,9 @@ def chatgpt_prompt(system_prompt, chat_messages, new_message):
 
     return messages
 
-def prompt_from_chat_messages(system_prompt, chat_messages, new_message, model="gpt-3.5-turbo"):
+def prompt_from_chat_messages(system_prompt, chat_messages, new_message, model="gpt-3.5-turbo", summary=None):
     if model in SUPPORTED_MODELS:
-        return chatgpt_prompt(system_prompt, chat_messages, new_message)
+        return chatgpt_prompt(system_prompt, chat_messages, new_message, summary=summary)
     else:
         raise NotImplementedError(f"""prompt_from_chat_messages() is not implemented for model {model}.""")
     
@@ -134,52 +148,68 @@ def reply_content(response, model, stream=False):
     else:
         raise NotImplementedError(f"""reply_content() is not implemented for model {model}.""")
     
-async def create_request(prompt, model, max_tokens=None, stream=False, api_type=None):
-    args = {}
-    if api_type == "azure":
+def _use_pooled_session():
+    # the openai client opens a new session per request unless one is set
+    openai.aiosession.set(http_client.get("openai"))
+
+async def create_request(prompt, model, max_tokens=None, stream=False, api_type=None, credential: key_pool.Credential = None):
+    if credential is None:
+        credential = key_pool.acquire(api_type, max_tokens or 0)
+
+    args = credential.request_args()
+    if credential.api_type == "azure":
         args["engine"] = model
-        args["api_type"] = api_type
-        args["api_base"] = config.AZURE_OPENAI_API_BASE
-        args["api_version"] = config.AZURE_OPENAI_API_VERSION
-        args["api_key"] = config.AZURE_OPENAI_API_KEY
     else:
         args["model"] = model
-        args["api_type"] = config.DEFAULT_OPENAI_API_TYPE
-        args["api_key"] = config.OPENAI_API_KEY
-
-    return await openai.ChatCompletion.acreate(
-        messages=prompt,
-        # request_timeout=config.OPENAI_TIMEOUT,
-        max_tokens=max_tokens,
-        stream=stream,
-        **args,
-    )
+
+    _use_pooled_session()
+    try:
+        return await deadline.run("chat", openai.ChatCompletion.acreate(
+            messages=prompt,
+            max_tokens=max_tokens,
+            stream=stream,
+            **args,
+        ))
+    except Exception as e:
+        key_pool.report_error(credential, e)
+        raise
     
 async def create_image(prompt, num_images: int = 1):
-    response = await openai.Image.acreate(
-        model="dall-e-3",
-        prompt=prompt,
-        size="1024x1024",
-        quality="standard",
-        n=num_images,
-        api_type=config.DEFAULT_OPENAI_API_TYPE,
-        api_key=config.OPENAI_API_KEY,
-    )
+    credential = key_pool.acquire(config.DEFAULT_OPENAI_API_TYPE)
+    _use_pooled_session()
+    try:
+        response = await deadline.run("image", openai.Image.acreate(
+            model="dall-e-3",
+            prompt=prompt,
+            size="1024x1024",
+            quality="standard",
+            n=num_images,
+            **credential.request_args(),
+        ))
+    except Exception as e:
+        key_pool.report_error(credential, e)
+        raise
     return response['data']
 
-async def audio_transcribe(filename):
-    audio_file= open(filename, "rb")
-    response = openai.Audio.transcribe(
-        "whisper-1", 
-        audio_file, 
-        api_type=config.DEFAULT_OPENAI_API_TYPE,
-        api_key=config.OPENAI_API_KEY,
-        )
+async def audio_transcribe(audio_file):
+    """Transcribes the file object, its name must have the extension of the format."""
+    credential = key_pool.acquire(config.DEFAULT_OPENAI_API_TYPE)
+    _use_pooled_session()
+    try:
+        response = await deadline.run("whisper", openai.Audio.atranscribe(
+            "whisper-1", 
+            audio_file, 
+            **credential.request_args(),
+            ))
+    except Exception as e:
+        key_pool.report_error(credential, e)
+        raise
     return response['text']
 
 async def moderation(prompt):
-    response = await openai.Moderation.acreate(
+    _use_pooled_session()
+    response = await deadline.run("moderation", openai.Moderation.acreate(
         input=prompt
-    )
+    ))
     output = response["results"][0]
     return not output["flagged"]
\ No newline at end of file
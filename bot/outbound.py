@@ -0,0 +1,203 @@
+import time
+import asyncio
+
+import telegram
+from telegram import Chat, Message, CallbackQuery
+
+import config
+import metrics
+
+# all replies and edits go through the scheduler to stay under Telegram's flood limits
+
+MAX_CHAT_BUCKETS = 1000
+# flood waits of one message before giving up
+MAX_RETRY_AFTER = 3
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, reserve: float = 0):
+        """Returns the seconds to wait until a token above `reserve` is available."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1 + reserve:
+            return 0
+        return (1 + reserve - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class PendingEdit:
+    def __init__(self, message: Message, text: str, kwargs: dict):
+        self.message = message
+        self.text = text
+        self.kwargs = kwargs
+
+class OutboundScheduler:
+    def __init__(self):
+        self.global_bucket = TokenBucket(config.TELEGRAM_GLOBAL_RATE, config.TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets = {}
+        # coalesced intermediate edits per message
+        self.pending_edits = {}
+        # the one task sending the intermediate edits of each message, in order
+        self.flush_tasks = {}
+        # messages whose intermediate edit is being sent
+        self.sending_edits = set()
+        # last intermediate edit time per message
+        self.last_edits = {}
+
+    def _chat_bucket(self, chat: Chat):
+        if chat.id not in self.chat_buckets:
+            if len(self.chat_buckets) > MAX_CHAT_BUCKETS:
+                # forget idle chats, their buckets are full again
+                now = time.monotonic()
+                for chat_id, bucket in list(self.chat_buckets.items()):
+                    if now - bucket.updated_at > 60 and now > bucket.paused_until:
+                        del self.chat_buckets[chat_id]
+            if chat.type == Chat.PRIVATE:
+                bucket = TokenBucket(config.TELEGRAM_PRIVATE_CHAT_RATE, 3)
+            else:
+                bucket = TokenBucket(config.TELEGRAM_GROUP_CHAT_RATE / 60, 3)
+            self.chat_buckets[chat.id] = bucket
+        return self.chat_buckets[chat.id]
+
+    def _edit_interval(self, chat: Chat):
+        """Minimal seconds between intermediate edits of a message, grows with the number of active streams."""
+        now = time.monotonic()
+        for key, last_edit_time in list(self.last_edits.items()):
+            if now - last_edit_time > config.STREAM_EDIT_MAX_INTERVAL:
+                del self.last_edits[key]
+        # keep some of the global budget for final edits and replies
+        interval = len(self.last_edits) / (config.TELEGRAM_GLOBAL_RATE * 0.8)
+        if chat.type == Chat.PRIVATE:
+            interval = max(interval, config.STREAM_EDIT_INTERVAL)
+        else:
+            interval = max(interval, 60 / config.TELEGRAM_GROUP_CHAT_RATE * 2)
+        metrics.set_gauge("outbound.streams", len(self.last_edits))
+        return min(interval, config.STREAM_EDIT_MAX_INTERVAL)
+
+    async def _acquire(self, chat: Chat, final: bool):
+        chat_bucket = self._chat_bucket(chat)
+        # intermediate edits leave a reserve of tokens for final messages
+        reserve = 0 if final else config.TELEGRAM_GLOBAL_RATE * 0.2
+        while True:
+            wait = max(self.global_bucket.wait_time(reserve), chat_bucket.wait_time(0 if final else 1))
+            if wait <= 0:
+                self.global_bucket.consume()
+                chat_bucket.consume()
+                return
+            await asyncio.sleep(wait)
+
+    async def send(self, chat: Chat, func):
+        """Calls `func` once the rate limits allow, retries after up to MAX_RETRY_AFTER flood waits."""
+        start_time = time.monotonic()
+        for attempt in range(MAX_RETRY_AFTER + 1):
+            await self._acquire(chat, final=True)
+            try:
+                result = await func()
+                metrics.observe("outbound.final", time.monotonic() - start_time)
+                return result
+            except telegram.error.RetryAfter as e:
+                metrics.inc("outbound.retry_after")
+                print(f"flood control on chat {chat.id}, retry after {e.retry_after}s")
+                self._chat_bucket(chat).pause(e.retry_after)
+                if attempt == MAX_RETRY_AFTER:
+                    raise
+
+    async def reply_text(self, message: Message, text: str, *args, **kwargs):
+        return await self.send(message.chat, lambda: message.reply_text(text, *args, **kwargs))
+
+    async def edit_message_text(self, query: CallbackQuery, text: str, *args, **kwargs):
+        return await self.send(query.message.chat, lambda: query.edit_message_text(text, *args, **kwargs))
+
+    async def edit_text(self, message: Message, text: str, *args, final: bool = True, **kwargs):
+        """Edits the message, intermediate edits (final=False) are coalesced to the latest text and not awaited."""
+        key = (message.chat_id, message.message_id)
+        if not final:
+            if key in self.pending_edits:
+                metrics.inc("outbound.coalesced")
+            self.pending_edits[key] = PendingEdit(message, text, kwargs)
+            if key not in self.flush_tasks:
+                self.flush_tasks[key] = asyncio.ensure_future(self._flush(key))
+            return message
+
+        self.pending_edits.pop(key, None)
+        task = self.flush_tasks.pop(key, None)
+        if task is not None:
+            if key in self.sending_edits:
+                # let the intermediate edit land first to keep the final text on top
+                await asyncio.wait({task})
+            else:
+                task.cancel()
+        self.last_edits.pop(key, None)
+        try:
+            return await self.send(message.chat, lambda: message.edit_text(text, *args, **kwargs))
+        except telegram.error.BadRequest as e:
+            if str(e).startswith("Message is not modified"):
+                return message
+            raise
+
+    async def _flush(self, key):
+        """Sends the latest pending text of the message until there is no newer one."""
+        try:
+            while key in self.pending_edits:
+                chat = self.pending_edits[key].message.chat
+                last_edit_time = self.last_edits.get(key)
+                if last_edit_time is not None:
+                    delay = last_edit_time + self._edit_interval(chat) - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                start_time = time.monotonic()
+                await self._acquire(chat, final=False)
+                # from now on newer texts wait for the next edit
+                pending = self.pending_edits.pop(key, None)
+                if pending is None:
+                    break
+                self.sending_edits.add(key)
+                self.last_edits[key] = time.monotonic()
+                try:
+                    await pending.message.edit_text(pending.text, **pending.kwargs)
+                    metrics.observe("outbound.intermediate", time.monotonic() - start_time)
+                except telegram.error.RetryAfter as e:
+                    metrics.inc("outbound.retry_after")
+                    print(f"flood control on chat {chat.id}, retry after {e.retry_after}s")
+                    self._chat_bucket(chat).pause(e.retry_after)
+                    # try again unless a newer text arrived meanwhile
+                    self.pending_edits.setdefault(key, pending)
+                except telegram.error.BadRequest as e:
+                    if not str(e).startswith("Message is not modified"):
+                        print(f"Telegram errors while editing text: {e}")
+                except Exception as e:
+                    print(f"Telegram errors while editing text: {e}")
+                finally:
+                    self.sending_edits.discard(key)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self.flush_tasks.get(key) is asyncio.current_task():
+                del self.flush_tasks[key]
+
+scheduler = OutboundScheduler()
+
+async def reply_text(message: Message, text: str, *args, **kwargs):
+    return await scheduler.reply_text(message, text, *args, **kwargs)
+
+async def edit_text(message: Message, text: str, *args, final: bool = True, **kwargs):
+    return await scheduler.edit_text(message, text, *args, final=final, **kwargs)
+
+async def edit_message_text(query: CallbackQuery, text: str, *args, **kwargs):
+    return await scheduler.edit_message_text(query, text, *args, **kwargs)
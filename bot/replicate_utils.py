@@ -1,3 +1,6 @@
+import asyncio
+import functools
+
 import replicate
 
 BASE_COST = 1000
@@ -74,7 +77,10 @@ async def inference(model, prompt, width, height):
         return None
     
     m = MODELS[model]
-    results = replicate.run(
+    # the replicate client blocks until the prediction finishes
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(None, functools.partial(
+        replicate.run,
         m["model_id"],
         input={
             **m["inputs"],
@@ -82,7 +88,7 @@ async def inference(model, prompt, width, height):
             "width": width,
             "height": height,
         }
-    )
+    ))
     print(results)
     return results
 
@@ -0,0 +1,138 @@
+import re
+import math
+import time
+import hashlib
+import collections
+
+import config
+import metrics
+import openai_utils
+
+# BM25 over chunks of the stored link context, only the relevant chunks are sent with each question
+
+# runs of CJK characters are indexed as characters and bigrams, other scripts as lowercase words
+CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+TERM_PATTERN = re.compile(f"[{CJK_RANGES}]+|\\w+")
+CJK_PATTERN = re.compile(f"[{CJK_RANGES}]")
+SEPARATOR = "\n\n[...]\n\n"
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+MAX_INDEXES = 100
+
+def tokenize(text: str):
+    terms = []
+    for m in TERM_PATTERN.finditer(text.lower()):
+        term = m.group(0)
+        if CJK_PATTERN.match(term):
+            terms.extend(term)
+            terms.extend(term[i:i + 2] for i in range(len(term) - 1))
+        elif len(term) > 1 or term.isdigit():
+            terms.append(term)
+    return terms
+
+def split_chunks(text: str, model: str, chunk_tokens: int):
+    """Packs paragraphs into chunks of about `chunk_tokens`, oversized paragraphs are cut by length."""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in text.split("\n"):
+        if not paragraph.strip():
+            continue
+        num_tokens = openai_utils.num_tokens_from_string(paragraph, model)
+        pieces = [(paragraph, num_tokens)]
+        if num_tokens > chunk_tokens:
+            step = max(1, len(paragraph) * chunk_tokens // num_tokens)
+            pieces = [(paragraph[i:i + step], chunk_tokens) for i in range(0, len(paragraph), step)]
+        for piece, piece_tokens in pieces:
+            if current and current_tokens + piece_tokens > chunk_tokens:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+class Index:
+    def __init__(self, chunks: list, model: str):
+        self.chunks = chunks
+        self.num_tokens = [openai_utils.num_tokens_from_string(chunk, model) for chunk in chunks]
+        self.term_freqs = [collections.Counter(tokenize(chunk)) for chunk in chunks]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        self.doc_freqs = collections.Counter()
+        for tf in self.term_freqs:
+            self.doc_freqs.update(tf.keys())
+
+    def idf(self, term: str):
+        n = len(self.chunks)
+        df = self.doc_freqs.get(term, 0)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str):
+        """Returns the (score, chunk index) of the chunks matching the query, best first."""
+        terms = set(tokenize(query))
+        results = []
+        for i, tf in enumerate(self.term_freqs):
+            score = 0
+            norm = K1 * (1 - B + B * self.lengths[i] / self.avg_length) if self.avg_length else K1
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self.idf(term) * freq * (K1 + 1) / (freq + norm)
+            if score > 0:
+                results.append((score, i))
+        results.sort(reverse=True)
+        return results
+
+_indexes = collections.OrderedDict()
+
+def content_hash(text: str):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def get_index(text: str, model: str) -> Index:
+    key = content_hash(text)
+    index = _indexes.get(key)
+    if index is None:
+        with metrics.timer("retrieval.index"):
+            index = Index(split_chunks(text, model, config.RETRIEVAL_CHUNK_TOKENS), model)
+        _indexes[key] = index
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    _indexes.move_to_end(key)
+    return index
+
+def select_context(text: str, query: str, model: str, min_tokens: int = None, budget: int = None):
+    """Returns the content to put in the prompt and whether it's the whole document or retrieved chunks.
+
+    Documents up to `min_tokens` are sent whole, chunks of longer ones are retrieved within `budget` tokens.
+    """
+    num_total_tokens = openai_utils.num_tokens_from_string(text, model)
+    min_tokens = config.RETRIEVAL_MIN_TOKENS if min_tokens is None else min_tokens
+    budget = config.RETRIEVAL_BUDGET if budget is None else budget
+    if not config.RETRIEVAL_ENABLED or num_total_tokens <= min_tokens:
+        metrics.inc("retrieval.full")
+        return text, "full"
+
+    start_time = time.monotonic()
+    index = get_index(text, model)
+    ranked = [i for _, i in index.search(query)][:config.RETRIEVAL_TOP_K]
+    if not ranked:
+        # nothing matches, e.g. "tell me more", start from the beginning
+        ranked = list(range(len(index.chunks)))
+    selected = []
+    num_tokens = 0
+    for i in ranked:
+        if num_tokens + index.num_tokens[i] > budget:
+            continue
+        selected.append(i)
+        num_tokens += index.num_tokens[i]
+    # keep the document order
+    content = SEPARATOR.join(index.chunks[i] for i in sorted(selected))
+    metrics.observe("retrieval.search", time.monotonic() - start_time)
+    metrics.inc("retrieval.retrieved")
+    metrics.inc("retrieval.saved_tokens", max(0, num_total_tokens - num_tokens))
+    return content, "retrieved"
@@ -0,0 +1,68 @@
+import asyncio
+
+import metrics
+
+class SingleFlight:
+    """Shares one execution among concurrent calls with the same key."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def do(self, key, func, *args, **kwargs):
+        while key in self._calls:
+            metrics.inc(f"singleflight.{self.name}.shared")
+            future = self._calls[key]
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # the waiter itself is cancelled
+                    raise
+                # the leader was cancelled, take over
+
+        future = self.begin(key)
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark the exception as retrieved in case nobody is waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def begin(self, key):
+        """Marks the key as in flight, the caller must call `end` with the result."""
+        metrics.inc(f"singleflight.{self.name}.executed")
+        future = asyncio.get_event_loop().create_future()
+        self._calls[key] = future
+        return future
+
+    def end(self, key, result=None):
+        future = self._calls.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def wait(self, key):
+        """Waits for the result of the call in flight, returns None if there is none."""
+        future = self._calls.get(key)
+        if future is None:
+            return None
+        metrics.inc(f"singleflight.{self.name}.shared")
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            return None
@@ -0,0 +1,176 @@
+import asyncio
+
+import openai
+
+import config
+import metrics
+import deadline
+import chatgpt
+import retrieval
+import openai_utils
+import answer_cache
+from database import Database
+
+# content too long for one prompt is summarized part by part concurrently (map),
+# the partial summaries are then summarized as a whole by the regular chat flow (reduce)
+
+MAP_PROMPT = """You are summarizing a long document part by part. Summarize the part {index} of {total} below.
+Keep the key points, facts, names, numbers and conclusions, skip the filler, and write in the language of the document."""
+
+PART_HEADER = "[{index}/{total}]\n"
+
+# summaries generated right after a link is ingested, taken when the summary is requested
+_speculative = answer_cache.LRUCache(config.SPECULATIVE_SUMMARY_CACHE_SIZE, config.SPECULATIVE_SUMMARY_TTL)
+_speculative_tasks = {}
+
+def _num_tokens(text: str):
+    return openai_utils.num_tokens_from_string(text, config.SUMMARY_MODEL)
+
+def needs_map_reduce(content: str):
+    return _num_tokens(content) > config.SUMMARY_SINGLE_PASS_TOKENS
+
+def estimated_cost(content: str):
+    """Cost of summarizing every part of the content once."""
+    prompt_cost_factor, completion_cost_factor = chatgpt.cost_factors(config.SUMMARY_MODEL)
+    num_tokens = _num_tokens(content)
+    num_parts = num_tokens // config.SUMMARY_CHUNK_TOKENS + 1
+    return int(num_tokens * prompt_cost_factor + num_parts * config.SUMMARY_PART_MAX_TOKENS * completion_cost_factor)
+
+def cache_key(chat_mode_id: str, prompt_pattern: str, model: str, content: str):
+    """Key of the final summary, summaries of the same content are shared across chats of the same chat mode."""
+    # the summary is written in the voice of the chat mode's system prompt
+    return answer_cache.cache_key(f"summarize.{chat_mode_id}", prompt_pattern, model, retrieval.content_hash(content))
+
+def _parts_cache_key(content: str):
+    return answer_cache.cache_key("summarize.parts", MAP_PROMPT, config.SUMMARY_MODEL, retrieval.content_hash(content))
+
+async def _summarize_part(db: Database, user_id: int, semaphore: asyncio.Semaphore, chunk: str, index: int, total: int):
+    model = config.SUMMARY_MODEL
+    prompt = openai_utils.chatgpt_prompt(MAP_PROMPT.format(index=index + 1, total=total), [], chunk)
+    async with semaphore:
+        for attempt in range(config.SUMMARY_MAX_RETRIES + 1):
+            try:
+                async for finished, answer, num_completion_tokens in chatgpt.send_message(prompt, model=model, max_tokens=config.SUMMARY_PART_MAX_TOKENS, api_type=config.OPENAI_CHAT_API_TYPE):
+                    pass
+                break
+            except openai.error.RateLimitError:
+                if attempt == config.SUMMARY_MAX_RETRIES:
+                    raise
+                # the key pool cools the limited key down, the retry goes to another key or waits it out
+                metrics.inc("summary.rate_limited")
+                await asyncio.sleep(2 ** attempt)
+    # bill each part as it completes, the parts done before a failure were still generated
+    num_prompt_tokens = openai_utils.num_tokens_from_messages(prompt, model)
+    prompt_cost_factor, completion_cost_factor = chatgpt.cost_factors(model)
+    db.inc_user_used_tokens(user_id, int(num_prompt_tokens * prompt_cost_factor + num_completion_tokens * completion_cost_factor))
+    metrics.inc("summary.parts")
+    return PART_HEADER.format(index=index + 1, total=total) + answer
+
+async def _map(db: Database, user_id: int, text: str, on_progress=None):
+    chunks = retrieval.split_chunks(text, config.SUMMARY_MODEL, config.SUMMARY_CHUNK_TOKENS)
+    semaphore = asyncio.Semaphore(config.SUMMARY_CONCURRENCY)
+    num_done = 0
+
+    async def summarize_part(index, chunk):
+        nonlocal num_done
+        part = await _summarize_part(db, user_id, semaphore, chunk, index, len(chunks))
+        num_done += 1
+        if on_progress is not None:
+            await on_progress(num_done, len(chunks))
+        return part
+
+    tasks = [asyncio.ensure_future(summarize_part(i, chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        parts = await asyncio.gather(*tasks)
+    except BaseException:
+        # one part failed or the summary was stopped, the other parts are useless
+        for task in tasks:
+            task.cancel()
+        raise
+    return "\n\n".join(parts)
+
+def cached_parts(db: Database, content: str):
+    """The partial summaries of the content if they are still cached, otherwise None."""
+    cached = answer_cache.get(db, _parts_cache_key(content))
+    return cached[0] if cached is not None else None
+
+def reduce_input(db: Database, content: str):
+    """What the final summary of the content was generated from, to measure and price a cached summary."""
+    parts = cached_parts(db, content)
+    if parts is not None:
+        return parts
+    # the partial summaries expired, they never exceed a single pass
+    return retrieval.split_chunks(content, config.SUMMARY_MODEL, config.SUMMARY_SINGLE_PASS_TOKENS)[0]
+
+async def condense(db: Database, user_id: int, content: str, on_progress=None):
+    """Replaces the content with summaries of its parts until it fits a single prompt, the result is cached by content hash."""
+    # the map gets its own deadline, the reduce starts a new one
+    deadline.start(config.SUMMARY_MAP_DEADLINE)
+    key = _parts_cache_key(content)
+    cached = cached_parts(db, content)
+    if cached is not None:
+        metrics.inc("summary.cache_hits")
+        return cached
+
+    text = content
+    with metrics.timer("summary.map"):
+        while _num_tokens(text) > config.SUMMARY_SINGLE_PASS_TOKENS:
+            text = await _map(db, user_id, text, on_progress)
+    metrics.inc("summary.map_reduced")
+    print(f"condensed {_num_tokens(content)} tokens into {_num_tokens(text)} tokens of partial summaries")
+    answer_cache.store(db, key, text, _num_tokens(text))
+    return text
+
+def speculate(db: Database, chat_id: int, user_id: int, key: str, prompt: list, model: str):
+    """Starts generating the summary of the chat's content in the background before it's requested."""
+    # held per chat, the billing depends on who requests it
+    speculation_key = (chat_id, key)
+    if speculation_key in _speculative_tasks or _speculative.get(speculation_key) is not None:
+        return
+    task = asyncio.ensure_future(_speculate(db, user_id, speculation_key, prompt, model))
+    _speculative_tasks[speculation_key] = task
+    task.add_done_callback(lambda t: _speculative_tasks.pop(speculation_key, None))
+
+async def _speculate(db: Database, user_id: int, speculation_key: tuple, prompt: list, model: str):
+    chat_id, key = speculation_key
+    # not bound by the deadline of the update which ingested the link
+    deadline.start()
+    if not answer_cache.begin_flight(key):
+        # already being summarized for another chat
+        return
+    result = None
+    try:
+        async for finished, answer, num_completion_tokens in chatgpt.send_message(prompt, model=model, api_type=config.OPENAI_CHAT_API_TYPE):
+            pass
+        result = (answer, num_completion_tokens)
+    except Exception as e:
+        metrics.inc("summary.speculative.errors")
+        print(f"failed to summarize speculatively: {e}")
+        return
+    finally:
+        answer_cache.end_flight(key, result)
+
+    prepaid = config.SPECULATIVE_SUMMARY_BILLING == "always"
+    if prepaid:
+        # the user pays for the summary whether it's requested or not
+        num_prompt_tokens = openai_utils.num_tokens_from_messages(prompt, model)
+        prompt_cost_factor, completion_cost_factor = chatgpt.cost_factors(model)
+        db.inc_user_used_tokens(user_id, int(num_prompt_tokens * prompt_cost_factor + num_completion_tokens * completion_cost_factor))
+    _speculative.set(speculation_key, (answer, num_completion_tokens, prepaid))
+    metrics.inc("summary.speculative.generated")
+    _report_speculation()
+
+async def take_speculative(chat_id: int, key: str):
+    """Returns the (answer, num_completion_tokens, prepaid) summarized in the background or None, waits if it's in progress."""
+    speculation_key = (chat_id, key)
+    task = _speculative_tasks.get(speculation_key)
+    if task is not None:
+        await asyncio.wait({task})
+    value = _speculative.pop(speculation_key)
+    if value is not None:
+        metrics.inc("summary.speculative.hits")
+        _report_speculation()
+    return value
+
+def _report_speculation():
+    metrics.set_gauge("summary.speculative.hit_ratio", round(metrics.ratio("summary.speculative.hits", "summary.speculative.generated"), 4))
@@ -0,0 +1,88 @@
+import re
+import html
+
+import config
+import metrics
+import openai_utils
+
+# YouTube transcripts as compact "[mm:ss] sentence" lines instead of JSON, within a token budget
+
+SENTENCE_END = re.compile(r"[.!?。！？…]['\")\]」』]*$")
+# generated transcripts have no punctuation, their fragments are merged up to this length
+SEGMENT_SECONDS = 30
+SEGMENT_CHARS = 400
+
+def preferred_languages(lang: str):
+    """YouTube language codes matching the Telegram or bot language code, best first."""
+    if not lang:
+        return []
+    lang = lang.replace("_", "-").lower()
+    if lang in ("zh-tw", "zh-hk", "zh-hant"):
+        return ["zh-hant", "zh-tw", "zh-hk", "zh"]
+    if lang.startswith("zh"):
+        return ["zh-hans", "zh-cn", "zh"]
+    base = lang.split("-")[0]
+    return [lang, base] if base != lang else [lang]
+
+def select_transcript(transcripts, languages: list):
+    """Picks the transcript in the preferred language, manually created ones first, otherwise the first manually created one."""
+    def rank(transcript):
+        code = transcript.language_code.lower()
+        for i, lang in enumerate(languages):
+            if code == lang or code.split("-")[0] == lang:
+                return i, transcript.is_generated
+        return len(languages), transcript.is_generated
+    transcripts = list(transcripts)
+    return min(transcripts, key=rank) if transcripts else None
+
+def format_timestamp(seconds: float):
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
+def merge_segments(entries: list):
+    """Merges the caption fragments into (start, text) sentences."""
+    segments = []
+    start = None
+    parts = []
+    num_chars = 0
+    for entry in entries:
+        text = " ".join(html.unescape(entry["text"]).split())
+        if not text:
+            continue
+        if start is None:
+            start = entry["start"]
+        parts.append(text)
+        num_chars += len(text)
+        end = entry["start"] + entry.get("duration", 0)
+        if SENTENCE_END.search(text) or end - start >= SEGMENT_SECONDS or num_chars >= SEGMENT_CHARS:
+            segments.append((start, " ".join(parts)))
+            start, parts, num_chars = None, [], 0
+    if parts:
+        segments.append((start, " ".join(parts)))
+    return segments
+
+def format_transcript(entries: list, model: str, max_tokens: int = None):
+    """Formats the transcript as timestamped lines, samples the lines evenly across the video if it's over the budget."""
+    max_tokens = max_tokens or config.TRANSCRIPT_MAX_TOKENS
+    lines = ["[{}] {}".format(format_timestamp(start), text) for start, text in merge_segments(entries)]
+    num_tokens = [openai_utils.num_tokens_from_string(line, model) + 1 for line in lines]
+    num_total_tokens = sum(num_tokens)
+    if num_total_tokens <= max_tokens:
+        return "\n".join(lines)
+
+    # keep a line while the kept tokens stay proportional to the position in the video, the timestamps show the gaps
+    selected = []
+    num_kept_tokens = 0
+    num_seen_tokens = 0
+    for line, n in zip(lines, num_tokens):
+        num_seen_tokens += n
+        if num_kept_tokens + n / 2 <= max_tokens * num_seen_tokens / num_total_tokens and num_kept_tokens + n <= max_tokens:
+            selected.append(line)
+            num_kept_tokens += n
+    metrics.inc("transcript.sampled")
+    print(f"sampled {len(selected)}/{len(lines)} transcript lines, {num_kept_tokens}/{num_total_tokens} tokens")
+    return "\n".join(selected)
@@ -1,12 +1,13 @@
-import os
+import io
 import re
-import aiohttp
 import json
 import functools
 import operator
 from pydub import AudioSegment
 
 import config
+import http_client
+import deadline
 
 TEXT_MAX_LENGTH = 250
     
@@ -70,64 +71,39 @@ async def _tts(voice_id, text, emotion="Neutral", speed=1):
         "voice_id": voice_id,
         "text": text
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, data=json.dumps(payload)) as response:
-            if response.status >= 200 and response.status < 300:
-                data = await response.json()
-                return data["id"], data["audio_url"]
-            else:
-                content = await response.text()
-                print(content)
-                raise Exception("temporary failure with the TTS server")
+    async with http_client.get().post(url, headers=headers, data=json.dumps(payload)) as response:
+        if response.status >= 200 and response.status < 300:
+            data = await response.json()
+            return data["id"], data["audio_url"]
+        else:
+            content = await response.text()
+            print(content)
+            raise Exception("temporary failure with the TTS server")
 
-async def _download(url, filename):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            with open(filename, 'wb') as f:
-                while True:
-                    chunk = await response.content.read(1024)
-                    if not chunk:
-                        break
-                    f.write(chunk)
+async def _download(url):
+    async with http_client.get().get(url) as response:
+        return await response.read()
 
-    
-async def tts(text, output, model):
+async def _synthesize(model, text, emotion, speed):
+    print(f"tts len: {len(text)}")
+    id, url = await deadline.run("tts", _tts(model, text, emotion=emotion, speed=speed))
+    data = await deadline.run("tts", _download(url))
+    return AudioSegment.from_file(io.BytesIO(data), format="wav")
+
+async def tts(text, model):
+    """Returns the speech as an AudioSegment, decoded and combined in memory."""
     text = _remove_emojis(text)
     chunks = _split_text(text, ['.', '?', '!'], TEXT_MAX_LENGTH)
 
-    basename, ext = os.path.splitext(output)
-    format = ext[1:]
-
     emotion = "Happy"
     speed = 1
 
     if len(chunks) == 0:
         raise Exception("Voice messages only support English")
-    elif len(chunks) == 1:
-        print(f"tts_to_file len: {len(text)}")
-        id, url = await _tts(model, text, emotion=emotion, speed=speed)
-        await _download(url, output)
-        final_seg = AudioSegment.from_file(output, format=format)
-    else:
-        filenames = []
-        for i, chunk in enumerate(chunks):
-            print(f"tts_to_file len: {len(chunk)}")
-            filename = f"{basename}{i}{ext}"
-            id, url = await _tts(model, chunk, emotion=emotion, speed=speed)
-            await _download(url, filename)
-            filenames.append(filename)
-            print(f"tts_to_file {filename}")
-
-        print(f"combine {len(filenames)} audios")
-        segments = [AudioSegment.from_file(filename, format=format) for filename in filenames]
-        combined = functools.reduce(operator.add, segments)
-        combined.export(output, format=format)
-        final_seg = combined
-
-        # cleanup
-        for filename in filenames:
-            os.remove(filename)
-
-    print(f"tts_to_file len: {len(text)}, duration: {final_seg.duration_seconds}s")
-    return output
+    segments = [await _synthesize(model, chunk, emotion, speed) for chunk in chunks]
+    if len(segments) > 1:
+        print(f"combine {len(segments)} audios")
+    final_seg = functools.reduce(operator.add, segments)
 
+    print(f"tts len: {len(text)}, duration: {final_seg.duration_seconds}s")
+    return final_seg
@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import aiohttp
+
+import config
+import metrics
+import helper
+import deadline
+import web_fetch
+import openai_utils
+from answer_cache import LRUCache
+from database import Database
+
+# extracted text of web pages shared across chats, revalidated with conditional requests once stale
+
+_memory = LRUCache(config.URL_CACHE_SIZE, config.URL_CACHE_TTL)
+
+def _is_fresh(entry: dict):
+    return (datetime.now() - entry["fetched_at"]).total_seconds() < config.URL_CACHE_FRESHNESS
+
+def _lookup(db: Database, key: str):
+    entry = _memory.get(key)
+    if entry is None:
+        entry = db.get_cached_url(key)
+        if entry is not None:
+            _memory.set(key, entry)
+    return entry
+
+def _store(db: Database, key: str, entry: dict):
+    entry["fetched_at"] = datetime.now()
+    _memory.set(key, entry)
+    db.set_cached_url(key, entry, entry["fetched_at"] + timedelta(seconds=config.URL_CACHE_TTL))
+
+async def get_text(db: Database, url: str):
+    """Returns the main text of the page from the cache, fetches or revalidates it if needed, None if it can't be fetched."""
+    key = helper.normalize_url(url)
+    entry = _lookup(db, key)
+    if entry is not None and _is_fresh(entry):
+        metrics.inc("url_cache.hits")
+        return entry["text"]
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        # bounded here rather than by the caller, a slow origin falls back to the stale copy
+        html, response = await deadline.run("fetch", web_fetch.download(url, headers))
+    except (aiohttp.ClientError, asyncio.TimeoutError, web_fetch.FetchError) as e:
+        metrics.inc("web_fetch.errors")
+        print(f"failed to fetch {url}: {e}")
+        if entry is not None:
+            # better a stale page than none
+            metrics.inc("url_cache.stale")
+            return entry["text"]
+        return None
+
+    if html is None and entry is not None:
+        metrics.inc("url_cache.revalidated")
+        _store(db, key, entry)
+        return entry["text"]
+
+    metrics.inc("url_cache.misses")
+    text = await web_fetch.extract(html or b"")
+    if text is None:
+        return None
+    _store(db, key, {
+        "url": url,
+        "text": text,
+        "num_tokens": openai_utils.num_tokens_from_string(text, openai_utils.MODEL_GPT_35_TURBO),
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    })
+    return text
@@ -0,0 +1,76 @@
+import time
+import asyncio
+import multiprocessing
+import concurrent.futures
+
+import trafilatura
+
+import config
+import metrics
+import http_client
+
+# downloads web pages on the pooled session with size and redirect caps, the text is extracted in worker processes
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36"
+# media is never worth downloading, unknown types are still tried
+MEDIA_CONTENT_TYPES = ("image/", "audio/", "video/", "font/", "application/pdf", "application/zip")
+CHUNK_SIZE = 64 * 1024
+
+class FetchError(Exception):
+    pass
+
+_pool = None
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # extraction is CPU bound, processes keep it off the event loop and the GIL.
+        # forking the bot itself can deadlock on locks held by the pymongo and pool threads,
+        # the workers are forked from a server that only loaded this module and has no threads
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["web_fetch"])
+        _pool = concurrent.futures.ProcessPoolExecutor(max_workers=config.WEB_EXTRACT_WORKERS, mp_context=context)
+    return _pool
+
+def _extract(html: bytes):
+    return trafilatura.extract(html, include_comments=False)
+
+async def download(url: str, headers: dict = None):
+    """Streams the page body up to WEB_FETCH_MAX_BYTES, returns (body, response), the body is None if not modified."""
+    start_time = time.monotonic()
+    headers = {"User-Agent": USER_AGENT, **(headers or {})}
+    async with http_client.get().get(url, headers=headers, max_redirects=config.WEB_FETCH_MAX_REDIRECTS) as response:
+        metrics.observe("web_fetch.connect", time.monotonic() - start_time)
+        if response.status == 304:
+            # answer of a conditional request
+            return None, response
+        if response.status != 200:
+            raise FetchError(f"HTTP {response.status}")
+        if response.content_type.startswith(MEDIA_CONTENT_TYPES):
+            raise FetchError(f"unsupported content type {response.content_type}")
+        if response.content_length is not None and response.content_length > config.WEB_FETCH_MAX_BYTES:
+            # the beginning of a page still has the most of its text
+            metrics.inc("web_fetch.truncated")
+
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            body += chunk
+            if len(body) >= config.WEB_FETCH_MAX_BYTES:
+                del body[config.WEB_FETCH_MAX_BYTES:]
+                if response.content_length is None:
+                    metrics.inc("web_fetch.truncated")
+                break
+    metrics.observe("web_fetch.download", time.monotonic() - start_time)
+    metrics.inc("web_fetch.bytes", len(body))
+    return bytes(body), response
+
+async def extract(html: bytes):
+    loop = asyncio.get_running_loop()
+    with metrics.timer("web_fetch.extract"):
+        return await loop.run_in_executor(_get_pool(), _extract, html)
+
+def close():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+        _pool = None
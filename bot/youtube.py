@@ -0,0 +1,90 @@
+import asyncio
+import concurrent.futures
+from datetime import datetime, timedelta
+
+import requests
+from youtube_transcript_api import _errors
+from youtube_transcript_api._transcripts import TranscriptListFetcher
+
+import config
+import metrics
+import transcript
+import openai_utils
+from answer_cache import LRUCache
+from database import Database
+
+# transcripts are fetched in a dedicated thread pool and cached by video, including videos without transcripts
+
+# the video has no usable transcript, worth remembering for a while
+UNAVAILABLE_ERRORS = (_errors.TranscriptsDisabled, _errors.NoTranscriptFound, _errors.NoTranscriptAvailable, _errors.VideoUnavailable)
+
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=config.YOUTUBE_WORKERS, thread_name_prefix="youtube")
+_memory = LRUCache(config.YOUTUBE_CACHE_SIZE, config.YOUTUBE_CACHE_TTL)
+
+class _TimeoutSession(requests.Session):
+    """The transcript API sends its requests without a timeout, a hung one would hold its worker forever."""
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", config.UPSTREAM_TIMEOUTS["youtube"])
+        return super().request(*args, **kwargs)
+
+def cache_key(video_id: str, languages: list):
+    return "youtube:{}:{}".format(video_id, ",".join(languages))
+
+def _fetch(video_id: str, languages: list):
+    """Returns the formatted transcript or None if the video has none, raises on other errors."""
+    print(f"parsing youtube {video_id} transcript ...")
+    try:
+        # same as YouTubeTranscriptApi.list_transcripts, with a timeout on every request
+        with _TimeoutSession() as http_client:
+            transcript_list = TranscriptListFetcher(http_client).fetch(video_id)
+            selected = transcript.select_transcript(transcript_list, languages)
+            if selected is None:
+                return None
+            # the Transcript object provides metadata properties
+            print(
+                selected.video_id,
+                selected.language,
+                selected.language_code,
+                # whether it has been manually created or generated by YouTube
+                selected.is_generated,
+            )
+            # compact timestamped lines use far fewer prompt tokens than the raw JSON
+            return transcript.format_transcript(selected.fetch(), openai_utils.MODEL_GPT_35_TURBO)
+    except UNAVAILABLE_ERRORS as e:
+        print(f"Youtube error: {type(e).__name__}")
+        return None
+
+async def get_transcript(db: Database, video_id: str, languages: list):
+    """Returns the transcript of the video in the preferred language or None if it's not available."""
+    key = cache_key(video_id, languages)
+    entry = _memory.get(key)
+    if entry is None:
+        entry = db.get_cached_url(key)
+        if entry is not None:
+            _memory.set(key, entry, ttl=(entry["expire_at"] - datetime.now()).total_seconds())
+    if entry is not None:
+        metrics.inc("youtube.hits")
+        return entry["text"]
+
+    metrics.inc("youtube.misses")
+    loop = asyncio.get_running_loop()
+    try:
+        with metrics.timer("youtube.fetch"):
+            text = await loop.run_in_executor(_pool, _fetch, video_id, languages)
+    except Exception as e:
+        # e.g. rate limited by YouTube, not cached
+        metrics.inc("youtube.errors")
+        print(e)
+        return None
+
+    ttl = config.YOUTUBE_CACHE_TTL if text is not None else config.YOUTUBE_NEGATIVE_CACHE_TTL
+    entry = {
+        "url": f"https://www.youtube.com/watch?v={video_id}",
+        "text": text,
+        "num_tokens": openai_utils.num_tokens_from_string(text, openai_utils.MODEL_GPT_35_TURBO) if text is not None else 0,
+        "fetched_at": datetime.now(),
+    }
+    _memory.set(key, entry, ttl=ttl)
+    db.set_cached_url(key, entry, datetime.now() + timedelta(seconds=ttl))
+    return text
@@ -0,0 +1,91 @@
+import sys, argparse
+sys.path.append('bot')
+
+from pymongo import UpdateOne
+
+import codec
+import database
+
+# compresses the large texts of existing documents and moves inline link contents to the contexts collection,
+# documents written by the bot since then are already in the new format and skipped.
+# it can run while the bot is up, a document changed since it was read is left for the next run
+
+parser = argparse.ArgumentParser(prog='storage migration')
+parser.add_argument('--dry-run', action='store_true', help='only count the documents to migrate')
+parser.add_argument('--batch-size', type=int, default=500)
+args = parser.parse_args()
+
+db = database.Database()
+
+class Batch:
+    def __init__(self, collection):
+        self.collection = collection
+        self.updates = []
+        self.num_docs = 0
+        self.num_bytes_before = 0
+        self.num_bytes_after = 0
+        self.num_skipped = 0
+
+    def add(self, doc_id, update, num_bytes_before, num_bytes_after, unchanged: dict = None):
+        """Queues the update, `unchanged` are the fields it was computed from, it only applies if they still match."""
+        self.num_docs += 1
+        self.num_bytes_before += num_bytes_before
+        self.num_bytes_after += num_bytes_after
+        if args.dry_run:
+            return
+        self.updates.append(UpdateOne({"_id": doc_id, **(unchanged or {})}, update))
+        if len(self.updates) >= args.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.updates:
+            result = self.collection.bulk_write(self.updates, ordered=False)
+            self.num_skipped += len(self.updates) - result.matched_count
+            self.updates = []
+
+    def report(self, name):
+        self.flush()
+        print("{}: {} documents, {:,} -> {:,} bytes, {} changed meanwhile and skipped".format(name, self.num_docs, self.num_bytes_before, self.num_bytes_after, self.num_skipped))
+
+def size(value):
+    if isinstance(value, str):
+        return len(value.encode())
+    return len(value) if value is not None else 0
+
+def migrate_chats():
+    batch = Batch(db.chat_collection)
+    for doc in db.chat_collection.find({}, {"messages": 1, "context": 1}):
+        update = {}
+        unchanged = {}
+        before = after = 0
+        messages = doc.get("messages") or []
+        encoded = [codec.encode_message(m) if "user" in m and "bot" in m else m for m in messages]
+        if any(e is not m and (e["user"] is not m["user"] or e["bot"] is not m["bot"]) for e, m in zip(encoded, messages)):
+            update["$set"] = {"messages": encoded}
+            # turns pushed since the read would be lost
+            unchanged["messages"] = messages
+            before += sum(size(m.get("user")) + size(m.get("bot")) for m in messages)
+            after += sum(size(m.get("user")) + size(m.get("bot")) for m in encoded)
+        context = doc.get("context")
+        if isinstance(context, str):
+            ref = db.store_context(context) if not args.dry_run else None
+            update.setdefault("$set", {})["context_ref"] = ref
+            update["$set"]["context"] = None
+            unchanged["context"] = context
+            before += size(context)
+        if update:
+            batch.add(doc["_id"], update, before, after, unchanged)
+    batch.report("chats")
+
+def migrate_cached_messages():
+    batch = Batch(db.message_collection)
+    for doc in db.message_collection.find({"message": {"$type": "string"}}):
+        encoded = codec.encode(doc["message"])
+        if encoded is not doc["message"]:
+            batch.add(doc["_id"], {"$set": {"message": encoded}}, size(doc["message"]), size(encoded), {"message": doc["message"]})
+    batch.report("cached messages")
+
+if __name__ == "__main__":
+    print("codec: {}".format("zstd" if codec.zstandard is not None else "zlib"))
+    migrate_chats()
+    migrate_cached_messages()
@@ -3,6 +3,7 @@ import sys, os, argparse
 sys.path.append('bot')
 import asyncio
 import time
+import tempfile
 import config
 import openai_utils
 import chatgpt
@@ -11,6 +12,8 @@ from pygame import mixer
 from youtube_transcript_api import YouTubeTranscriptApi, _errors
 import trafilatura
 import helper
+import markdown_renderer
+import audio_utils
 
 parser = argparse.ArgumentParser(prog='prompt tester')
 parser.add_argument('-p', '--prompts')
@@ -47,6 +50,37 @@ def test_parse_youtube():
         video_id = helper.parse_youtube_id(url) if is_youtube_url else None
         print(f"is_youtube_url={is_youtube_url}, video_id={video_id}, url={url}")
 
+# answers in Markdown and the expected Telegram HTML
+MARKDOWN_CASES = [
+    ("**bold** and *italic*", "<b>bold</b> and <i>italic</i>"),
+    ("a * b * c ** d __init__ snake_case_var", "a * b * c ** d __init__ snake_case_var"),
+    ("x **** y", "x **** y"),
+    ("call __init__ and **__main__**", "call __init__ and <b>__main__</b>"),
+    ("**unclosed and *", "**unclosed and *"),
+    ("# **Title**", "<b>Title</b>"),
+    ("```\na\n~~~\nb\n```", "<pre>a\n~~~\nb</pre>"),
+]
+
+def test_markdown_renderer():
+    for text, expected in MARKDOWN_CASES:
+        chunks = markdown_renderer.render(text)
+        assert chunks == [expected], f"{text!r} rendered as {chunks!r}, expected {expected!r}"
+    print(f"markdown_renderer: {len(MARKDOWN_CASES)} cases passed")
+
+async def test_prepare_for_whisper():
+    # phones often record M4A with the moov atom after the audio data, it can't be demuxed from a pipe
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "voice.m4a")
+        await audio_utils.ffmpeg("-f", "lavfi", "-i", "sine=duration=2", "-c:a", "aac", path)
+        with open(path, "rb") as f:
+            data = f.read()
+    assert audio_utils.is_iso_media(data) and data.find(b"moov") > data.find(b"mdat")
+    with audio_utils.AudioBuffer("voice.x-m4a", data) as audio:
+        upload, method = await audio_utils.prepare_for_whisper(audio, "x-m4a")
+        with upload:
+            assert upload.size() > 0
+    print(f"prepare_for_whisper: moov at the end {method}d to {upload.name}")
+
 def play_audio(file):
     mixer.init()
     mixer.music.load(file)
@@ -165,15 +199,18 @@ async def test():
         if answer is not None:
             if args.tts and role in config.TTS_MODELS:
                 tts_model = config.TTS_MODELS[role]
-                output = await tts_helper.tts(answer, output=WAV_OUTPUT_PATH, model=tts_model)
-                if output:
-                    play_audio(output)
+                seg = await tts_helper.tts(answer, model=tts_model)
+                if seg:
+                    seg.export(WAV_OUTPUT_PATH, format="wav")
+                    play_audio(WAV_OUTPUT_PATH)
             if "disable_history" not in config.CHAT_MODES[role]:
                 # add messages to context
                 dialog.append({"user": text, "bot": answer})
 
 if __name__ == "__main__":
     test_parse_youtube()
+    test_markdown_renderer()
+    asyncio.run(test_prepare_for_whisper())
     openai_utils.print_gpt_models()
     print()
     print_roles()